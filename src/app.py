@@ -1,9 +1,9 @@
+import argparse
 import logging
 import os
 
-import pyaudiowpatch as pyaudio
-
 from src import rlistener
+from src.common import sim
 from src.common.sim import LogUtil, ConfigUtil
 
 
@@ -27,21 +27,32 @@ if __name__ == "__main__":
 
     print(f"[app] working directory {os.getcwd()}")
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--headless", action="store_true", help="no gui, same as gui.active: false")
+    args = parser.parse_args()
+
     init_env()
     init_logger()
 
     logger = logging.getLogger('main')
 
+    listener = None
     try:
         cfg = load_config()
-        py_audio = pyaudio.PyAudio()
-        rlistener = rlistener.RListener(
+        if args.headless:
+            sim.setv(cfg, False, "gui", "active")
+        listener = rlistener.RListener(
             cfg=cfg,
-            py_audio=py_audio,
         )
-        rlistener.start()
-        rlistener.gui_mainloop()
+        if listener.headless:
+            # the main thread blocks on the command queue
+            listener.run()
+        else:
+            listener.start()
+            listener.gui_mainloop()
     except KeyboardInterrupt:
         logger.info("KeyboardInterrupt: terminating...")
+        if listener is not None:
+            listener.terminiate()
     except Exception as e:
         logger.error(e, exc_info=True, stack_info=True)
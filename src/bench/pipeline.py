@@ -0,0 +1,294 @@
+""" End-to-end benchmark: replays a corpus of audio files through
+recorder (file source) -> slicer -> transcriber -> translator (stub agent) -> manifest,
+and reports the real-time factor, the stage latencies, peak rss and cpu use as json.
+
+    python -m src.bench.pipeline corpus/ --out bench/results.json
+    python -m src.bench.pipeline a.wav b.flac --model small --speed 4 --set transcriber.batch.active=true
+"""
+import argparse
+import copy
+import datetime
+import json
+import logging
+import os
+import subprocess
+import time
+
+import numpy
+import yaml
+
+from src import rtask, rrecord, rdenoise, rslice, rtranscribe, rtranslate, rmanifest
+from src.common import sim
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".ogg", ".opus", ".m4a", ".aac", ".webm", ".mp4", ".mkv")
+
+QUANTILES = (50, 95, 99)
+
+
+def corpus_of(paths) -> list:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if name.lower().endswith(AUDIO_EXTENSIONS))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def quantiles_of(samples: list) -> dict:
+    if len(samples) <= 0:
+        return {}
+    ret = {f"p{q}": round(float(numpy.percentile(samples, q)), 3) for q in QUANTILES}
+    ret["mean"] = round(float(numpy.mean(samples)), 3)
+    ret["count"] = len(samples)
+    return ret
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(peak / (1024 * 1024 if os.uname().sysname == "Darwin" else 1024), 1)
+
+
+def commit_of() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+class RBench:
+    """ One pipeline per corpus file, the whisper model is loaded once and shared by all the runs.
+
+    A run is over when the recorder reached the end of the file, the queues are empty
+    and no task went through a stage for `idle` seconds.
+    """
+
+    SPANS = list(rtask.RInfo.SPANS)
+
+    def __init__(self, cfg: dict, idle: float = 3, timeout: float = 600):
+        self.cfg = cfg
+        self.idle = idle
+        self.timeout = timeout
+        self.model = None
+        self.spans = {name: [] for name in self.SPANS}
+        self.rtf = []
+        self.logger = logging.getLogger('bench')
+
+    @staticmethod
+    def configure(cfg: dict, model: str, device: str, compute_type: str, speed: float, overrides: list) -> dict:
+        """ bench defaults on top of the app config: file source, stub translator, no redis, no output """
+        sim.setv(cfg, False, "listener", "redis")
+        sim.setv(cfg, "file", "recorder", "source")
+        sim.setv(cfg, speed, "recorder", "speed")
+        sim.setv(cfg, model, "transcriber", "model_size")
+        sim.setv(cfg, device, "transcriber", "device")
+        sim.setv(cfg, compute_type, "transcriber", "compute_type")
+        sim.setv(cfg, 1, "translator", "number")
+        sim.setv(cfg, True, "translator", "agent_stub", "active")
+        for agent in ("agent_google", "agent_poe", "agent_ollama"):
+            sim.setv(cfg, False, "translator", agent, "active")
+        sim.setv(cfg, False, "translator", "phoneme", "convert")
+        sim.setv(cfg, 0, "translator", "cache_redis", "fetch")
+        sim.setv(cfg, 0, "translator", "cache_redis", "persist")
+        for unit in ("console", "barrage", "file"):
+            sim.setv(cfg, False, "manifest", unit, "active")
+        for override in overrides:
+            key, value = override.split("=", 1)
+            sim.setv(cfg, yaml.safe_load(value), *key.split("."))
+        return cfg
+
+    def activity(self, task_ctrl: rtask.RTaskControl) -> int:
+        """ grows whenever a task goes through a stage """
+        total = 0
+        for metric in task_ctrl.metrics.snapshot().values():
+            if not isinstance(metric, dict):
+                continue
+            for series in metric.values():
+                if isinstance(series, dict):
+                    total += series.get("count", 0)
+                else:
+                    total += series
+        return total
+
+    def pending(self, task_ctrl: rtask.RTaskControl) -> int:
+        return task_ctrl.queue_denoise.qsize() + task_ctrl.queue_slice.qsize() + task_ctrl.queue_transcribe.qsize() + \
+            task_ctrl.queue_translate.qsize() + task_ctrl.queue_manifest.qsize()
+
+    def run_one(self, path: str) -> dict:
+        cfg = copy.deepcopy(self.cfg)
+        sim.setv(cfg, path, "recorder", "file", "path")
+        task_ctrl = rtask.RTaskControl(cfg=cfg, gui_root=None)
+
+        stages = []
+        try:
+            transcribers = []
+            for i in range(sim.getv(cfg, 1, "transcriber", "number")):
+                transcriber = rtranscribe.RTranscriber(task_ctrl=task_ctrl, index=i + 1)
+                if self.model is None:
+                    transcriber.init(True)
+                    self.model = transcriber.model
+                transcriber.model = self.model
+                transcribers.append(transcriber)
+            translators = [rtranslate.RTranslator(task_ctrl=task_ctrl, index=i + 1)
+                           for i in range(sim.getv(cfg, 1, "translator", "number"))]
+            renderer = rmanifest.RManifest(task_ctrl=task_ctrl)
+            slicer = rslice.RSlicer(task_ctrl=task_ctrl)
+            recorder = rrecord.Recorder(task_ctrl=task_ctrl)
+            recorder.init()
+
+            stages.extend([renderer, *translators, *transcribers, slicer])
+            if sim.getv(cfg, False, "denoiser", "active"):
+                stages.append(rdenoise.RDenoiser(task_ctrl=task_ctrl))
+            for stage in stages:
+                stage.start()
+
+            cpu_start = time.process_time()
+            start = time.monotonic()
+            recorder.start()
+            recorder.join()
+
+            # cpu time is taken at the same instants as wall time: up to the last activity, not the idle wait
+            last = time.monotonic()
+            cpu_last = time.process_time()
+            activity = self.activity(task_ctrl)
+            while time.monotonic() - start < self.timeout:
+                time.sleep(0.1)
+                current = self.activity(task_ctrl)
+                if current != activity or self.pending(task_ctrl) > 0:
+                    activity = current
+                    last = time.monotonic()
+                    cpu_last = time.process_time()
+                elif time.monotonic() - last >= self.idle:
+                    break
+            else:
+                self.logger.warning(f"timed out after {self.timeout}s: {path}")
+
+            wall = last - start
+            cpu = cpu_last - cpu_start
+        finally:
+            # the stages end on the terminate signal, the thread pool and the arena's shared memory go with it
+            task_ctrl.terminate()
+            for stage in stages:
+                if stage.is_alive():
+                    stage.join(timeout=10)
+
+        latency = task_ctrl.metrics.histogram("stage_latency_ms")
+        spans = {}
+        for name in self.SPANS:
+            samples = latency.samples(stage=name)
+            self.spans[name].extend(samples)
+            spans[name] = quantiles_of(samples)
+        rtf = task_ctrl.metrics.histogram("transcribe_rtf").samples()
+        self.rtf.extend(rtf)
+
+        audio = recorder.frames * recorder.frame_duration / 1000
+        snapshot = task_ctrl.metrics.snapshot()
+        result = {
+            "file": path,
+            "audio_seconds": round(audio, 3),
+            "wall_seconds": round(wall, 3),
+            # wall time over audio time for the whole pipeline, < 1 is faster than real time
+            "rtf": round(wall / audio, 4) if audio > 0 else None,
+            "transcribe_rtf": quantiles_of(rtf),
+            "spans_ms": spans,
+            "tasks": spans.get("all", {}).get("count", 0),
+            "cpu_seconds": round(cpu, 3),
+            "cpu_utilization": round(cpu / wall / (os.cpu_count() or 1), 4) if wall > 0 else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "dropped": snapshot.get("queue_dropped_total", {}),
+            "expired": snapshot.get("deadline_expired_total", {}),
+            "agent_calls": snapshot.get("translate_agent_calls_total", {}),
+        }
+        self.logger.info(f"{path} | audio: {result['audio_seconds']}s | wall: {result['wall_seconds']}s | "
+                         f"rtf: {result['rtf']} | tasks: {result['tasks']}")
+        return result
+
+    def run(self, files: list) -> dict:
+        results = [self.run_one(path) for path in files]
+        audio = sum(result["audio_seconds"] for result in results)
+        wall = sum(result["wall_seconds"] for result in results)
+        cpu = sum(result["cpu_seconds"] for result in results)
+        return {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": commit_of(),
+            "config": {
+                "transcriber": sim.getv(self.cfg, {}, "transcriber"),
+                "translator": {key: value for key, value in sim.getv(self.cfg, {}, "translator").items()
+                               if not key.startswith("agent_") or key == "agent_stub"},
+                "recorder": {"speed": sim.getv(self.cfg, 1, "recorder", "speed")},
+                "slicer": sim.getv(self.cfg, {}, "slicer"),
+                "queues": sim.getv(self.cfg, {}, "queues"),
+                "deadline": sim.getv(self.cfg, {}, "deadline"),
+            },
+            "total": {
+                "files": len(results),
+                "audio_seconds": round(audio, 3),
+                "wall_seconds": round(wall, 3),
+                "rtf": round(wall / audio, 4) if audio > 0 else None,
+                "transcribe_rtf": quantiles_of(self.rtf),
+                "spans_ms": {name: quantiles_of(samples) for name, samples in self.spans.items()},
+                "cpu_utilization": round(cpu / wall / (os.cpu_count() or 1), 4) if wall > 0 else None,
+                "peak_rss_mb": peak_rss_mb(),
+            },
+            "files": results,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end pipeline benchmark")
+    parser.add_argument("corpus", nargs="+", help="audio files, or directories of them")
+    parser.add_argument("--config", default="./config/def.yaml")
+    parser.add_argument("--model", default="tiny")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--compute-type", default="int8")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed, 0: as fast as possible")
+    parser.add_argument("--idle", type=float, default=3, help="seconds without activity that end a run")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds a run may take at most")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="config override, e.g. transcriber.beam_size=1")
+    parser.add_argument("--out", default="", help="json results, printed when empty")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(name)s] %(levelname)s - %(message)s")
+    logging.getLogger("faster_whisper").setLevel(logging.ERROR)
+
+    files = corpus_of(args.corpus)
+    if len(files) <= 0:
+        raise SystemExit(f"no audio file in {args.corpus}")
+
+    cfg = RBench.configure(
+        cfg=sim.ConfigUtil.load_yaml(args.config),
+        model=args.model,
+        device=args.device,
+        compute_type=args.compute_type,
+        speed=args.speed,
+        overrides=args.set,
+    )
+    results = RBench(cfg, idle=args.idle, timeout=args.timeout).run(files)
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if len(args.out) <= 0:
+        print(text)
+        return
+    directory = os.path.dirname(args.out)
+    if len(directory) > 0:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import collections
+import threading
+from multiprocessing import shared_memory
+
+import numpy
+
+
+class ArenaBlock:
+    """ A reference counted range [offset, offset + length) of float32 samples in an AudioArena.
+
+    The block goes back to the arena when the last reference is released, views over it
+    must not be used after that.
+    """
+
+    __slots__ = ("arena", "offset", "length", "refs", "freed")
+
+    def __init__(self, arena: 'AudioArena', offset: int, length: int):
+        self.arena = arena
+        self.offset = offset
+        self.length = length
+        self.refs = 1
+        self.freed = False
+
+    def view(self) -> numpy.ndarray:
+        return self.arena.view(self.offset, self.length)
+
+    def handle(self) -> tuple:
+        """ (arena name, offset, length), enough for another process to attach, see AudioArena.attach """
+        return self.arena.name, self.offset, self.length
+
+    def retain(self) -> 'ArenaBlock':
+        with self.arena.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        self.arena.release(self)
+
+
+class AudioArena:
+    """ Pre-allocated float32 sample buffer the slices' model input is written into once,
+    then handed on by reference (ArenaBlock) instead of by copy.
+
+    Blocks are allocated as in a ring: after the newest block, or from the start once the end is
+    reached, up to the oldest block still referenced. Blocks are mostly released in the order they
+    were allocated; one released out of order is reclaimed with the blocks before it.
+    alloc() returns None when the arena is full, the caller keeps its samples in its own array then.
+
+    shared: the buffer is a multiprocessing.shared_memory block, worker processes attach it by name.
+    """
+
+    def __init__(self, capacity: int, shared: bool = False):
+        if capacity <= 0:
+            raise Exception(f"invalid arena size: {capacity}")
+        self.capacity = capacity
+        self.memory: shared_memory.SharedMemory = None
+        self.name = ""
+        if shared:
+            self.memory = shared_memory.SharedMemory(create=True, size=capacity * 4)
+            self.name = self.memory.name
+            buffer = self.memory.buf
+        else:
+            buffer = bytearray(capacity * 4)
+        self.samples = numpy.ndarray((capacity,), dtype=numpy.float32, buffer=buffer)
+
+        # live blocks in allocation order, the first one is the tail of the ring
+        self.blocks = collections.deque()
+        self.head = 0
+        self.lock = threading.Lock()
+
+        self.allocated = 0
+        self.failed = 0
+
+    @staticmethod
+    def attach(name: str, capacity: int) -> 'AudioArena':
+        """ the arena of another process, read only by convention, blocks are released by their owner """
+        arena = AudioArena.__new__(AudioArena)
+        arena.capacity = capacity
+        arena.memory = shared_memory.SharedMemory(name=name)
+        arena.name = name
+        arena.samples = numpy.ndarray((capacity,), dtype=numpy.float32, buffer=arena.memory.buf)
+        arena.blocks = collections.deque()
+        arena.head = 0
+        arena.lock = threading.Lock()
+        arena.allocated = 0
+        arena.failed = 0
+        return arena
+
+    def view(self, offset: int, length: int) -> numpy.ndarray:
+        return self.samples[offset:offset + length]
+
+    def offset_of(self, length: int) -> int:
+        """ where a block of length fits, -1 if nowhere; with the lock held """
+        if len(self.blocks) <= 0:
+            return 0 if length <= self.capacity else -1
+        tail = self.blocks[0].offset
+        newest = self.blocks[-1]
+        if newest.offset >= tail:
+            # not wrapped: free after the newest block, then before the oldest one
+            if self.head + length <= self.capacity:
+                return self.head
+            return 0 if length <= tail else -1
+        # wrapped: free between the newest and the oldest block
+        return self.head if self.head + length <= tail else -1
+
+    def alloc(self, length: int) -> ArenaBlock:
+        if length <= 0:
+            return None
+        with self.lock:
+            offset = self.offset_of(length)
+            if offset < 0:
+                self.failed += 1
+                return None
+            block = ArenaBlock(self, offset, length)
+            self.blocks.append(block)
+            self.head = offset + length
+            self.allocated += 1
+            return block
+
+    def release(self, block: ArenaBlock):
+        with self.lock:
+            if block.freed:
+                return
+            block.refs -= 1
+            if block.refs > 0:
+                return
+            block.freed = True
+            while len(self.blocks) > 0 and self.blocks[0].freed:
+                self.blocks.popleft()
+            if len(self.blocks) <= 0:
+                self.head = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            used = sum(block.length for block in self.blocks if not block.freed)
+            return {
+                "capacity": self.capacity,
+                "live": len(self.blocks),
+                "used": used,
+                "allocated": self.allocated,
+                "failed": self.failed,
+            }
+
+    def unlink(self):
+        """ at shutdown: the name goes away, the memory stays mapped until the views over it are gone """
+        if self.memory is None or len(self.name) <= 0:
+            return
+        self.memory.unlink()
+        self.name = ""
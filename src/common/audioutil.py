@@ -0,0 +1,173 @@
+import numpy
+
+from src.common import importutil
+
+MODEL_SAMPLE_RATE = 16000
+
+
+# Convert =============================================================================== #
+
+def to_float32(data, sample_width: int = 2) -> numpy.ndarray:
+    """ pcm bytes (or an integer-scaled numpy array) into float32 within [-1, 1] """
+    scale = float(1 << (8 * sample_width - 1))
+    if isinstance(data, numpy.ndarray):
+        return (data.astype(numpy.float32) / scale).astype(numpy.float32, copy=False)
+    if sample_width == 1:
+        samples = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.float32) - 128
+        return samples / 128
+    if sample_width == 2:
+        return numpy.frombuffer(data, dtype=numpy.int16).astype(numpy.float32) / scale
+    if sample_width == 4:
+        return numpy.frombuffer(data, dtype=numpy.int32).astype(numpy.float32) / scale
+    raise Exception(f"unsupported sample width: {sample_width}")
+
+
+def downmix(samples: numpy.ndarray, channels: int) -> numpy.ndarray:
+    if channels <= 1:
+        return samples
+    frames = len(samples) // channels
+    return samples[:frames * channels].reshape(frames, channels).mean(axis=1, dtype=numpy.float32)
+
+
+def resample(samples: numpy.ndarray, rate_src: int, rate_des: int) -> numpy.ndarray:
+    if rate_src == rate_des or len(samples) <= 0:
+        return samples
+    gcd = numpy.gcd(int(rate_src), int(rate_des))
+    # scipy is only needed when the capture rate is not the model's
+    signal = importutil.load("scipy.signal")
+    ret = signal.resample_poly(samples, rate_des // gcd, rate_src // gcd)
+    return ret.astype(numpy.float32, copy=False)
+
+
+def to_model_input(
+        data,
+        sample_rate: int,
+        sample_width: int = 2,
+        sample_channels: int = 1,
+        target_rate: int = MODEL_SAMPLE_RATE,
+) -> numpy.ndarray:
+    """ captured pcm -> float32 mono at the whisper sample rate, ready for model.transcribe """
+    samples = to_float32(data, sample_width)
+    samples = downmix(samples, sample_channels)
+    samples = resample(samples, sample_rate, target_rate)
+    return numpy.ascontiguousarray(samples, dtype=numpy.float32)
+
+
+PCM_TYPES = {1: numpy.uint8, 2: numpy.int16, 4: numpy.int32}
+
+
+def to_model_input_into(
+        data,
+        out: numpy.ndarray,
+        sample_width: int = 2,
+        sample_channels: int = 1,
+) -> numpy.ndarray:
+    """ captured pcm already at the model sample rate -> float32 mono written into out, len(out) frames,
+    without any intermediate array
+    """
+    dtype = PCM_TYPES.get(sample_width, None)
+    if dtype is None:
+        raise Exception(f"unsupported sample width: {sample_width}")
+    pcm = numpy.frombuffer(data, dtype=dtype, count=len(out) * sample_channels)
+    pcm = pcm.reshape(len(out), sample_channels)
+    if sample_channels == 1:
+        numpy.copyto(out, pcm[:, 0], casting="unsafe")
+    else:
+        numpy.mean(pcm, axis=1, dtype=numpy.float32, out=out)
+    if sample_width == 1:
+        out -= 128
+        out /= 128
+    else:
+        out /= float(1 << (8 * sample_width - 1))
+    return out
+
+
+# Capture ============================================================================== #
+
+class Resampler:
+    """ Stateful polyphase resampler of a mono float32 stream, chunk after chunk.
+
+    A kaiser windowed sinc low pass is designed once for the up / down ratio and split into
+    its `up` phases, each output sample is one dot product of `taps` input samples with one phase,
+    computed for a whole chunk at once. The last taps - 1 input samples are carried to the next
+    chunk, so chunk edges leave no trace. The output lags by about taps / 2 input samples.
+    """
+
+    def __init__(self, rate_src: int, rate_des: int, taps: int = 32, beta: float = 8.0):
+        gcd = numpy.gcd(int(rate_src), int(rate_des))
+        self.up = int(rate_des) // gcd
+        self.down = int(rate_src) // gcd
+        self.taps = taps
+
+        size = taps * self.up
+        cutoff = 1 / max(self.up, self.down)
+        t = numpy.arange(size) - (size - 1) / 2
+        h = cutoff * numpy.sinc(cutoff * t) * numpy.kaiser(size, beta)
+        # unity gain once the zeros of the upsampling are counted
+        h *= self.up / numpy.sum(h)
+        # phases[p, i]: coefficient of the i-th sample of a window (oldest first) for phase p
+        self.phases = h.reshape(taps, self.up).T[:, ::-1].astype(numpy.float32)
+
+        self.history = numpy.zeros(taps - 1, dtype=numpy.float32)
+        # stream positions: next input sample, next output sample
+        self.consumed = 0
+        self.produced = 0
+
+    def process(self, samples: numpy.ndarray) -> numpy.ndarray:
+        if len(samples) <= 0:
+            return numpy.zeros(0, dtype=numpy.float32)
+        buffer = numpy.concatenate((self.history, samples.astype(numpy.float32, copy=False)))
+        last = self.consumed + len(samples) - 1
+        # every output whose newest input sample arrived
+        end = (last * self.up + self.up - 1) // self.down + 1
+        n = numpy.arange(self.produced, end, dtype=numpy.int64)
+        newest = n * self.down // self.up
+        phase = n * self.down % self.up
+        windows = numpy.lib.stride_tricks.sliding_window_view(buffer, self.taps)[newest - self.consumed]
+        out = numpy.einsum("ij,ij->i", windows, self.phases[phase])
+        self.history = buffer[len(buffer) - (self.taps - 1):]
+        self.consumed += len(samples)
+        self.produced = end
+        return out.astype(numpy.float32, copy=False)
+
+
+class CaptureConverter:
+    """ Captured interleaved int16 pcm -> int16 mono at the target rate, as soon as it is read.
+
+    mode: mix (channels averaged), pick (channel `pick`), max (the channel with the most energy,
+    smoothed over the chunks so that it does not flip on every chunk)
+    """
+
+    MODES = ("mix", "pick", "max")
+
+    def __init__(self, rate_src: int, channels_src: int, rate_des: int, mode: str = "mix", pick: int = 0,
+                 taps: int = 32):
+        if mode not in self.MODES:
+            raise Exception(f"unknown channel mode: {mode}, expected one of {self.MODES}")
+        self.rate_src = rate_src
+        self.channels_src = channels_src
+        self.rate_des = rate_des
+        self.mode = mode
+        self.pick = min(max(pick, 0), channels_src - 1)
+        self.energy = numpy.zeros(channels_src, dtype=numpy.float64)
+        self.resampler = Resampler(rate_src, rate_des, taps) if rate_src != rate_des else None
+
+    def downmix(self, pcm: numpy.ndarray) -> numpy.ndarray:
+        frames = pcm.reshape(-1, self.channels_src)
+        if self.channels_src <= 1:
+            return frames[:, 0].astype(numpy.float32)
+        if self.mode == "pick":
+            return frames[:, self.pick].astype(numpy.float32)
+        if self.mode == "max":
+            power = numpy.mean(numpy.square(frames, dtype=numpy.float64), axis=0)
+            self.energy = 0.8 * self.energy + 0.2 * power
+            return frames[:, int(numpy.argmax(self.energy))].astype(numpy.float32)
+        return numpy.mean(frames, axis=1, dtype=numpy.float32)
+
+    def process(self, data) -> bytes:
+        pcm = numpy.frombuffer(data, dtype=numpy.int16)
+        pcm = pcm[:len(pcm) // self.channels_src * self.channels_src]
+        samples = self.downmix(pcm)
+        if self.resampler is not None:
+            samples = self.resampler.process(samples)
+        return numpy.clip(numpy.rint(samples), -32768, 32767).astype(numpy.int16).tobytes()
@@ -0,0 +1,136 @@
+import collections
+import logging
+import threading
+import time
+
+from src.common.stats import LatencyWindow
+
+
+class CircuitBreaker:
+    """ Closed / open / half-open circuit breaker around one backend.
+
+    closed: calls go through, the error rate over the last `window` seconds is watched
+    open: after too many errors, calls are rejected right away for `open_time` seconds
+    half-open: then a single probe call goes through, its success closes the circuit, its failure reopens it
+
+    Calls are given a timeout derived from the observed latency: quantile * factor, within [min, max].
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(
+            self,
+            name: str,
+            latency: LatencyWindow = None,
+            window: float = 30,
+            min_calls: int = 5,
+            error_rate: float = 0.5,
+            open_time: float = 30,
+            timeout: dict = None,
+    ):
+        self.name = name
+        self.latency = latency if latency is not None else LatencyWindow()
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_time = open_time
+        self.timeouts = timeout or {}
+
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.probing = False
+        self.calls = collections.deque()
+
+        self.successes = 0
+        self.failures = 0
+        self.rejections = 0
+        self.opens = 0
+
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(f'breaker-{name}')
+
+    def trim(self, now: float):
+        while len(self.calls) > 0 and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self.opened_at + self.open_time:
+                self.state = self.HALF_OPEN
+                self.logger.info("half-open, probing")
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.rejections += 1
+            return False
+
+    def success(self, latency: float):
+        self.latency.add(latency)
+        with self.lock:
+            now = time.monotonic()
+            self.successes += 1
+            self.calls.append((now, True))
+            self.trim(now)
+            if self.state != self.CLOSED:
+                self.state = self.CLOSED
+                self.probing = False
+                self.calls.clear()
+                self.logger.info("closed")
+
+    def failure(self) -> bool:
+        """ record a failed call, True if it opened the circuit """
+        with self.lock:
+            now = time.monotonic()
+            self.failures += 1
+            self.calls.append((now, False))
+            self.trim(now)
+            if self.state == self.HALF_OPEN:
+                return self.open(now)
+            if self.state == self.CLOSED and len(self.calls) >= self.min_calls:
+                errors = sum(1 for _, ok in self.calls if not ok)
+                if errors / len(self.calls) >= self.error_rate:
+                    return self.open(now)
+            return False
+
+    def cancel(self):
+        """ the call was abandoned (e.g. lost a race), neither success nor failure """
+        with self.lock:
+            self.probing = False
+
+    def open(self, now: float) -> bool:
+        self.state = self.OPEN
+        self.opened_at = now
+        self.probing = False
+        self.opens += 1
+        self.logger.warning(f"open for {self.open_time}s")
+        return True
+
+    def timeout(self) -> float:
+        """ seconds a call may take """
+        default = self.timeouts.get("default", 10)
+        if len(self.latency) < self.timeouts.get("samples", 10):
+            return default
+        quantile = self.latency.quantile(self.timeouts.get("quantile", 0.95)) / 1000
+        ret = quantile * self.timeouts.get("factor", 3)
+        return min(max(ret, self.timeouts.get("min", 1)), self.timeouts.get("max", 30))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self.trim(time.monotonic())
+            errors = sum(1 for _, ok in self.calls if not ok)
+            return {
+                "state": self.state,
+                "state_value": self.STATE_VALUES[self.state],
+                "successes": self.successes,
+                "failures": self.failures,
+                "rejections": self.rejections,
+                "opens": self.opens,
+                "error_rate": round(errors / len(self.calls), 4) if len(self.calls) > 0 else 0,
+                "timeout": round(self.timeout(), 3),
+            }
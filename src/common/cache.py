@@ -0,0 +1,64 @@
+import collections
+import threading
+import time
+
+
+class LruCache:
+    """ Thread-safe, bounded LRU cache with an optional ttl (seconds, 0: never expires).
+
+    hits / misses / evictions / expirations are counted for metrics.
+    """
+
+    def __init__(self, size: int = 1024, ttl: float = 0):
+        self.size = size
+        self.ttl = ttl
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expire = entry
+            if 0 < expire < time.monotonic():
+                del self.data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expire = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        with self.lock:
+            self.data[key] = (value, expire)
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / total, 4) if total > 0 else 0,
+        }
@@ -0,0 +1,138 @@
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class SpectralGate:
+    """ Streaming spectral gate: stft -> gain per bin -> istft with overlap-add, over a continuous stream.
+
+    The noise profile is a running mean / variance (dB) per frequency bin, updated only with
+    the stft frames that contain no speech. A bin louder than mean + n_std * std passes,
+    a quieter one is attenuated by prop_decrease. The gains are smoothed across frames.
+
+    process() costs O(new samples): the input tail and the overlap-add accumulator are carried
+    from one call to the next. The output is the input delayed by n_fft - hop samples,
+    flush() returns what is still held back.
+    The noise profile is kept across streams, the rest starts over after a flush.
+    """
+
+    def __init__(
+            self,
+            channels: int = 1,
+            n_fft: int = 512,
+            overlap: int = 4,
+            n_std: float = 1.5,
+            prop_decrease: float = 0.9,
+            noise_update: float = 0.05,
+            noise_frames: int = 20,
+            gain_smoothing: float = 0.5,
+    ):
+        self.channels = channels
+        self.n_fft = n_fft
+        self.hop = n_fft // overlap
+        self.n_std = n_std
+        self.prop_decrease = prop_decrease
+        self.noise_update = noise_update
+        self.noise_frames_min = noise_frames
+        self.gain_smoothing = gain_smoothing
+
+        # sqrt hann for analysis and synthesis, hann once combined
+        self.window = numpy.sqrt(numpy.hanning(n_fft + 1)[:-1]).astype(numpy.float32)
+        self.norm = float(numpy.sum(self.window ** 2) / self.hop)
+
+        bins = n_fft // 2 + 1
+        self.noise_mean = numpy.zeros(bins, dtype=numpy.float32)
+        self.noise_var = numpy.zeros(bins, dtype=numpy.float32)
+        self.noise_frames = 0
+        self.gain = numpy.ones(bins, dtype=numpy.float32)
+
+        self.pending: numpy.ndarray = None
+        self.pending_noise: numpy.ndarray = None
+        self.output: numpy.ndarray = None
+        self.skip = 0
+        self.reset()
+
+    def noise_learn(self, db: numpy.ndarray):
+        if self.noise_frames <= 0:
+            self.noise_mean[:] = db
+        else:
+            rate = max(self.noise_update, 1 / (self.noise_frames + 1))
+            delta = db - self.noise_mean
+            self.noise_mean += rate * delta
+            self.noise_var = (1 - rate) * (self.noise_var + rate * delta * delta)
+        self.noise_frames += 1
+
+    def gains_of(self, db: numpy.ndarray, noise: numpy.ndarray) -> numpy.ndarray:
+        """ gain per frame and bin, the noise profile learns from the frames without speech on the way """
+        gains = numpy.empty_like(db)
+        for i in range(len(db)):
+            if noise[i]:
+                self.noise_learn(db[i])
+            if self.noise_frames < self.noise_frames_min:
+                gain = 1
+            else:
+                threshold = self.noise_mean + self.n_std * numpy.sqrt(self.noise_var)
+                gain = numpy.where(db[i] > threshold, 1, 1 - self.prop_decrease)
+            self.gain = self.gain_smoothing * self.gain + (1 - self.gain_smoothing) * gain
+            gains[i] = self.gain
+        return gains
+
+    def trim(self, out: numpy.ndarray) -> numpy.ndarray:
+        """ drop the output of the zeros put ahead of the stream """
+        cut = min(self.skip, out.shape[1])
+        self.skip -= cut
+        return out[:, cut:]
+
+    def process(self, samples: numpy.ndarray, noise: numpy.ndarray) -> numpy.ndarray:
+        """ samples: float32 (channels, n), noise: (n,) True where there is no speech,
+        returns the denoised float32 (channels, m) of the frames complete so far
+        """
+        return self.trim(self.overlap_add(samples, noise))
+
+    def overlap_add(self, samples: numpy.ndarray, noise: numpy.ndarray) -> numpy.ndarray:
+        buffer = numpy.concatenate((self.pending, samples), axis=1)
+        flags = numpy.concatenate((self.pending_noise, noise))
+        count = (buffer.shape[1] - self.n_fft) // self.hop + 1 if buffer.shape[1] >= self.n_fft else 0
+        if count <= 0:
+            self.pending = buffer
+            self.pending_noise = flags
+            return numpy.zeros((self.channels, 0), dtype=numpy.float32)
+
+        frames = sliding_window_view(buffer, self.n_fft, axis=1)[:, ::self.hop][:, :count]
+        spectrum = numpy.fft.rfft(frames * self.window, axis=-1)
+        power = numpy.mean(numpy.abs(spectrum) ** 2, axis=0)
+        db = (10 * numpy.log10(power + 1e-12)).astype(numpy.float32)
+        noise_frames = sliding_window_view(flags, self.n_fft)[::self.hop][:count].all(axis=1)
+
+        spectrum *= self.gains_of(db, noise_frames)
+        frames = numpy.fft.irfft(spectrum, n=self.n_fft, axis=-1).astype(numpy.float32) * self.window
+
+        done = count * self.hop
+        held = self.n_fft - self.hop
+        acc = numpy.zeros((self.channels, done + held), dtype=numpy.float32)
+        acc[:, :held] = self.output
+        for i in range(count):
+            acc[:, i * self.hop:i * self.hop + self.n_fft] += frames[:, i]
+        self.output = acc[:, done:]
+        self.pending = buffer[:, done:]
+        self.pending_noise = flags[done:]
+        return acc[:, :done] / self.norm
+
+    def flush(self) -> numpy.ndarray:
+        """ the samples still held back, the state is ready for a new stream afterwards """
+        size = self.pending.shape[1]
+        held = self.n_fft - self.hop
+        out = self.overlap_add(
+            numpy.zeros((self.channels, held + self.hop), dtype=numpy.float32),
+            numpy.zeros(held + self.hop, dtype=bool),
+        )
+        out = self.trim(out[:, :size])
+        self.reset()
+        return out
+
+    def reset(self):
+        # zeros ahead of the stream, so its first samples get the full overlap too
+        held = self.n_fft - self.hop
+        self.pending = numpy.zeros((self.channels, held), dtype=numpy.float32)
+        self.pending_noise = numpy.ones(held, dtype=bool)
+        self.output = numpy.zeros((self.channels, held), dtype=numpy.float32)
+        self.skip = held
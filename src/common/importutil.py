@@ -0,0 +1,40 @@
+""" Heavy optional dependencies (whisper, cutlet, poe, ollama, redis, tk...) are imported on first use,
+once the config asks for them, through load(), which also times each import for the startup report.
+"""
+import importlib
+import sys
+import threading
+import time
+
+started = time.perf_counter()
+
+_profile = {}
+_lock = threading.Lock()
+
+
+def load(name: str):
+    """ import the module `name` (dotted) if it is not yet, and remember how long it took.
+
+    Always through importlib, which waits on the module's import lock: sys.modules already holds a module
+    another thread is still initializing.
+    """
+    loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _profile.setdefault(name, elapsed)
+    return module
+
+
+def profile() -> dict:
+    """ seconds per lazily imported module, in import order; a module imported by another one counts in both """
+    with _lock:
+        return dict(_profile)
+
+
+def report() -> str:
+    items = sorted(profile().items(), key=lambda item: item[1], reverse=True)
+    imports = " | ".join(f"{name}: {elapsed:.3f}s" for name, elapsed in items)
+    return f"startup {time.perf_counter() - started:.3f}s | lazy imports: {imports if len(imports) > 0 else 'none'}"
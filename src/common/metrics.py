@@ -0,0 +1,195 @@
+import math
+import threading
+
+from src.common.stats import LatencyWindow
+
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 4)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def labels_of(names: tuple, values: dict) -> tuple:
+    return tuple(str(values.get(name, "")) for name in names)
+
+
+def labels_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if len(extra) > 0:
+        pairs.append(extra)
+    if len(pairs) <= 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def number_text(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str = "", labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> list:
+        lines = self.header()
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{labels_text(self.labels, key)} {number_text(value)}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            if len(self.labels) <= 0:
+                return self.values.get((), 0)
+            return {"|".join(key): value for key, value in self.values.items()}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = labels_of(self.labels, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = labels_of(self.labels, labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """ Cumulative buckets for prometheus, plus the latest `window` samples for exact recent quantiles """
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str = "", labels: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                 window: int = 1000):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.window = window
+
+    def observe(self, value: float, **labels):
+        key = labels_of(self.labels, labels)
+        with self.lock:
+            series = self.values.get(key, None)
+            if series is None:
+                series = self.values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0,
+                    "count": 0,
+                    "recent": LatencyWindow(size=self.window),
+                }
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+        series["recent"].add(value)
+
+    def samples(self, **labels) -> list:
+        """ the recent samples of one series """
+        with self.lock:
+            series = self.values.get(labels_of(self.labels, labels), None)
+        if series is None:
+            return []
+        with series["recent"].lock:
+            return list(series["recent"].samples)
+
+    def render(self) -> list:
+        lines = self.header()
+        recent = [f"# HELP {self.name}_recent {self.doc}, over the latest {self.window} samples",
+                  f"# TYPE {self.name}_recent summary"]
+        with self.lock:
+            items = list(self.values.items())
+        for key, series in items:
+            for bound, count in zip(self.buckets, series["buckets"]):
+                le = labels_text(self.labels, key, f'le="{number_text(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{labels_text(self.labels, key)} {number_text(series['sum'])}")
+            lines.append(f"{self.name}_count{labels_text(self.labels, key)} {series['count']}")
+            for q in QUANTILES:
+                quantile = labels_text(self.labels, key, f'quantile="{q}"')
+                recent.append(f"{self.name}_recent{quantile} {number_text(series['recent'].quantile(q))}")
+        return lines + recent
+
+    def snapshot(self):
+        with self.lock:
+            items = list(self.values.items())
+        ret = {}
+        for key, series in items:
+            summary = {"count": series["count"], "mean": round(series["sum"] / max(series["count"], 1), 3)}
+            for q in QUANTILES:
+                summary[f"p{round(q * 100)}"] = series["recent"].quantile(q)
+            ret["|".join(key) if len(key) > 0 else "all"] = summary
+        return ret
+
+
+class Registry:
+    """ Named metrics of the process, rendered as prometheus text or a json-able dict.
+
+    Collectors are called right before rendering, to pull the values that are only known
+    to their owners (queue sizes, cache and breaker stats...).
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name: str, doc: str, labels: tuple, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name, None)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, doc, labels, **kwargs)
+            return metric
+
+    def counter(self, name: str, doc: str = "", labels: tuple = ()) -> Counter:
+        return self.get(Counter, name, doc, labels)
+
+    def gauge(self, name: str, doc: str = "", labels: tuple = ()) -> Gauge:
+        return self.get(Gauge, name, doc, labels)
+
+    def histogram(self, name: str, doc: str = "", labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.get(Histogram, name, doc, labels, buckets=buckets)
+
+    def collector(self, key: str, collect):
+        """ register collect(registry) under key, registering the same key again replaces it """
+        with self.lock:
+            self.collectors[key] = collect
+
+    def collect(self):
+        with self.lock:
+            collectors = list(self.collectors.values())
+        for collect in collectors:
+            collect(self)
+
+    def render(self) -> str:
+        self.collect()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        self.collect()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
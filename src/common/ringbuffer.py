@@ -0,0 +1,83 @@
+import threading
+
+
+class RingBuffer:
+    """ Fixed-size, pre-allocated ring of pcm frames.
+
+    The writer copies each captured frame into its slot once; readers get memoryview
+    slices over the slots instead of new bytes objects. A view stays valid until the
+    writer laps it, check() tells whether that happened.
+
+    dropped: frames overwritten before the reader took them
+    overwritten: views a consumer found stale when it came back to them
+    """
+
+    def __init__(self, frame_bytes: int, capacity: int):
+        if frame_bytes <= 0 or capacity <= 0:
+            raise Exception(f"invalid ring buffer size: {frame_bytes} x {capacity}")
+        self.frame_bytes = frame_bytes
+        self.capacity = capacity
+        self.buffer = bytearray(frame_bytes * capacity)
+        self.view = memoryview(self.buffer)
+
+        # sequence of the next frame to write / to read, they only grow
+        self.head = 0
+        self.tail = 0
+
+        self.dropped = 0
+        self.overwritten = 0
+
+        self.cond = threading.Condition()
+
+    def write(self, data) -> int:
+        """ copy whole frames of data into the ring, returns the sequence of the first one """
+        count = min(len(data) // self.frame_bytes, self.capacity)
+        source = memoryview(data).cast("B")
+        seq = self.head
+        slot = seq % self.capacity
+        first = min(count, self.capacity - slot)
+        self.view[slot * self.frame_bytes:(slot + first) * self.frame_bytes] = source[:first * self.frame_bytes]
+        if count > first:
+            self.view[:(count - first) * self.frame_bytes] = source[first * self.frame_bytes:count * self.frame_bytes]
+        with self.cond:
+            self.head += count
+            lag = self.head - self.tail - self.capacity
+            if lag > 0:
+                self.dropped += lag
+                self.tail += lag
+            self.cond.notify_all()
+        return seq
+
+    def read(self, max_frames: int = 0, timeout: float = None):
+        """ take the pending frames that are contiguous in memory, returns (sequence, count) """
+        with self.cond:
+            if self.head == self.tail:
+                self.cond.wait(timeout)
+            count = self.head - self.tail
+            if count <= 0:
+                return self.tail, 0
+            count = min(count, self.capacity - self.tail % self.capacity)
+            if max_frames > 0:
+                count = min(count, max_frames)
+            seq = self.tail
+            self.tail += count
+            return seq, count
+
+    def frames(self, seq: int, count: int = 1) -> memoryview:
+        """ zero-copy view over count frames starting at seq, must not cross the end of the ring """
+        offset = (seq % self.capacity) * self.frame_bytes
+        return self.view[offset:offset + count * self.frame_bytes]
+
+    def valid(self, seq: int) -> bool:
+        # the next write goes to the slot of seq head - capacity
+        return seq > self.head - self.capacity
+
+    def check(self, seq: int) -> bool:
+        if self.valid(seq):
+            return True
+        with self.cond:
+            self.overwritten += 1
+        return False
+
+    def pending(self) -> int:
+        return self.head - self.tail
@@ -169,6 +169,30 @@ class Text:
                 new_text += "\n"
         return new_text
 
+    @staticmethod
+    def dedupe_overlap(prev: str, text: str, max_units: int = 16) -> str:
+        """
+        Drop the head of text that repeats the tail of prev.
+        Compares words, or characters when text has no spaces (CJK).
+        """
+        spaced = len(text.split()) > 1
+        if spaced:
+            units_prev = prev.split()
+            units = text.split()
+            min_units = 1
+        else:
+            units_prev = list("".join(prev.split()))
+            units = list(text.strip())
+            min_units = 2
+
+        def norm(unit):
+            return unit.strip(".,!?;:\"'、。，！？").lower()
+
+        for k in range(min(max_units, len(units_prev), len(units)), min_units - 1, -1):
+            if [norm(u) for u in units_prev[-k:]] == [norm(u) for u in units[:k]]:
+                return (" " if spaced else "").join(units[k:])
+        return text
+
 
 # Time =============================================================================== #
 
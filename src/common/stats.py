@@ -0,0 +1,25 @@
+import collections
+import threading
+
+
+class LatencyWindow:
+    """ The latest `size` latency samples (ms) of something, for quantiles """
+
+    def __init__(self, size: int = 100):
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self.lock:
+            self.samples.append(latency)
+
+    def quantile(self, q: float, default: float = 0) -> float:
+        with self.lock:
+            if len(self.samples) <= 0:
+                return default
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+        return ordered[index]
+
+    def __len__(self):
+        return len(self.samples)
@@ -0,0 +1,83 @@
+import logging
+
+import numpy
+
+from src.common import importutil
+
+WEBRTC_SAMPLE_RATES = (8000, 16000, 32000, 48000)
+
+
+class BlockVad:
+    """ Classify a whole block of pcm frames in one call.
+
+    Frames quieter than energy_floor (dBFS), or noisier than zcr_max zero-crossings per sample,
+    are marked as non-speech by a numpy pre-filter; only the remaining candidates go through webrtcvad.
+    """
+
+    def __init__(
+            self,
+            mode: int = 1,
+            energy_floor: float = -55,
+            zcr_max: float = 0,
+    ):
+        # webrtcvad goes through pkg_resources, a good part of the startup
+        self.vad = importutil.load("webrtcvad").Vad()
+        self.vad.set_mode(mode)
+        self.energy_floor = energy_floor
+        self.zcr_max = zcr_max
+        self.logger = logging.getLogger('vad')
+
+    @staticmethod
+    def frames_of(data, sample_width: int, sample_channels: int, frame_samples: int) -> numpy.ndarray:
+        """ mono int16 frames, shape (count, frame_samples) """
+        if isinstance(data, numpy.ndarray):
+            samples = data.reshape(-1)
+        elif sample_width == 2:
+            samples = numpy.frombuffer(data, dtype=numpy.int16)
+        else:
+            raise Exception(f"unsupported sample width for vad: {sample_width}")
+        count = len(samples) // (frame_samples * sample_channels)
+        samples = samples[:count * frame_samples * sample_channels]
+        if sample_channels > 1:
+            samples = samples.reshape(-1, sample_channels).mean(axis=1)
+        return samples.reshape(count, frame_samples).astype(numpy.int16, copy=False)
+
+    @staticmethod
+    def energy_of(frames: numpy.ndarray) -> numpy.ndarray:
+        """ rms energy per frame in dBFS """
+        samples = frames.astype(numpy.float32) / 32768
+        rms = numpy.sqrt(numpy.mean(samples * samples, axis=1))
+        return 20 * numpy.log10(rms + 1e-10)
+
+    @staticmethod
+    def zcr_of(frames: numpy.ndarray) -> numpy.ndarray:
+        signs = numpy.signbit(frames)
+        return numpy.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / frames.shape[1]
+
+    def classify(
+            self,
+            data,
+            sample_rate: int,
+            sample_width: int,
+            sample_channels: int,
+            frame_duration: int = 10,
+    ):
+        """ returns (speech mask, energy in dBFS), one entry per frame """
+        frame_samples = sample_rate * frame_duration // 1000
+        frames = self.frames_of(data, sample_width, sample_channels, frame_samples)
+        energy = self.energy_of(frames)
+
+        candidate = energy >= self.energy_floor
+        if self.zcr_max > 0:
+            candidate &= self.zcr_of(frames) <= self.zcr_max
+
+        if sample_rate not in WEBRTC_SAMPLE_RATES:
+            return candidate, energy
+
+        mask = numpy.zeros(len(frames), dtype=bool)
+        for i in numpy.flatnonzero(candidate):
+            try:
+                mask[i] = self.vad.is_speech(frames[i].tobytes(), sample_rate)
+            except Exception as ex:
+                self.logger.error(f"vad.is_speech() failed - frame len {frame_samples} - {ex}")
+        return mask, energy
@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+
+import numpy
+
+from src import rtask
+from src.common import sim
+from src.common.denoiseutil import SpectralGate
+from src.common.vadutil import BlockVad
+
+
+class RDenoiser(threading.Thread):
+    """ Streaming noise reduction between the recorder and the slicer (denoiser.active).
+
+    The captured blocks go through one SpectralGate, so each block costs its own length only,
+    and the noise profile learns from the frames its own vad pass finds without speech.
+    The output is cut in whole frames for the slicer, the remainder waits for the next block.
+    """
+
+    def __init__(
+            self,
+            task_ctrl: rtask.RTaskControl,
+    ):
+        super().__init__()
+        self.task_ctrl = task_ctrl
+        self.do_run = True
+
+        self.vad: BlockVad = None
+        self.gate: SpectralGate = None
+        self.frame_duration = 10
+        # ms of audio per stft frame, rounded up to a power of two in samples
+        self.window = 32
+        self.overlap = 4
+        self.n_std = 1.5
+        self.prop_decrease = 0.9
+        self.noise_update = 0.05
+        self.noise_frames = 20
+        self.gain_smoothing = 0.5
+
+        # denoised samples short of a whole frame, (channels, n)
+        self.carry: numpy.ndarray = None
+        # blocks dropped as the ring overwrote them before they were denoised
+        self.dropped = 0
+
+        self.logger = logging.getLogger('denoiser')
+        self.configure()
+
+    def configure(self) -> 'RDenoiser':
+        cfg = sim.getv(self.task_ctrl.cfg, {}, "denoiser")
+        self.window = sim.getv(cfg, 32, "window")
+        self.overlap = sim.getv(cfg, 4, "overlap")
+        self.n_std = sim.getv(cfg, 1.5, "n_std")
+        self.prop_decrease = sim.getv(cfg, 0.9, "prop_decrease")
+        self.noise_update = sim.getv(cfg, 0.05, "noise_update")
+        self.noise_frames = sim.getv(cfg, 20, "noise_frames")
+        self.gain_smoothing = sim.getv(cfg, 0.5, "gain_smoothing")
+        self.frame_duration = sim.getv(self.task_ctrl.cfg, 10, "recorder", "frame_duration")
+        # the slicer's vad settings, without its windowing: a single speech frame keeps a stft frame out of the profile
+        cfg_vad = sim.getv(self.task_ctrl.cfg, {}, "slicer", "vad")
+        self.vad = BlockVad(
+            mode=sim.getv(cfg_vad, 1, "mode"),
+            energy_floor=sim.getv(cfg_vad, -55, "energy_floor"),
+            zcr_max=sim.getv(cfg_vad, 0, "zcr_max"),
+        )
+        return self
+
+    def gate_of(self, param: rtask.RParam) -> SpectralGate:
+        if self.gate is None:
+            n_fft = 1 << int(numpy.ceil(numpy.log2(param.sample_rate * self.window / 1000)))
+            self.gate = SpectralGate(
+                channels=param.sample_channels,
+                n_fft=n_fft,
+                overlap=self.overlap,
+                n_std=self.n_std,
+                prop_decrease=self.prop_decrease,
+                noise_update=self.noise_update,
+                noise_frames=self.noise_frames,
+                gain_smoothing=self.gain_smoothing,
+            )
+            self.carry = numpy.zeros((param.sample_channels, 0), dtype=numpy.float32)
+            self.logger.info(f"spectral gate | n_fft: {n_fft} | hop: {self.gate.hop} | "
+                             f"latency: {(n_fft - self.gate.hop) * 1000 // param.sample_rate}ms")
+        return self.gate
+
+    def denoise(self, task: rtask.RTask) -> numpy.ndarray:
+        param = task.param
+        gate = self.gate_of(param)
+        frame_samples = param.sample_rate * self.frame_duration // 1000
+        pcm = numpy.frombuffer(task.audio, dtype=numpy.int16)
+        pcm = pcm[:len(pcm) // param.sample_channels * param.sample_channels]
+        samples = pcm.reshape(-1, param.sample_channels).T.astype(numpy.float32) / 32768
+
+        mask, _ = self.vad.classify(
+            data=task.audio,
+            sample_rate=param.sample_rate,
+            sample_width=param.sample_width,
+            sample_channels=param.sample_channels,
+            frame_duration=self.frame_duration,
+        )
+        noise = numpy.zeros(samples.shape[1], dtype=bool)
+        noise[:len(mask) * frame_samples] = numpy.repeat(~mask, frame_samples)
+        return gate.process(samples, noise)
+
+    def forward(self, task: rtask.RTask, samples: numpy.ndarray):
+        """ whole frames of the denoised samples to the slicer, as int16 pcm of the captured layout """
+        param = task.param
+        frame_samples = param.sample_rate * self.frame_duration // 1000
+        samples = numpy.concatenate((self.carry, samples), axis=1)
+        count = samples.shape[1] // frame_samples * frame_samples
+        self.carry = samples[:, count:]
+        if count <= 0:
+            return
+        pcm = numpy.clip(samples[:, :count].T * 32768, -32768, 32767).astype(numpy.int16)
+        denoised = rtask.RTask(
+            audio=pcm.tobytes(),
+            sample_rate=param.sample_rate,
+            sample_width=param.sample_width,
+            sample_channels=param.sample_channels,
+            info=task.info,
+        )
+        self.task_ctrl.queue_slice.put(denoised)
+
+    def detach(self, task: rtask.RTask) -> bool:
+        """ copy a block out of the recorder ring, False when it was overwritten before (the block is dropped) """
+        task.audio = bytes(task.audio)
+        # checked after the copy: an overwrite during the copy shows as well
+        if task.ring.check(task.ring_seq):
+            task.ring = None
+            return True
+        self.dropped += 1
+        self.task_ctrl.metrics.counter("denoise_dropped_total", "Captured blocks dropped by the denoiser", ("reason",)) \
+            .inc(reason="overwritten")
+        self.logger.warning(f"block overwritten in the ring buffer, dropped: {self.dropped} | "
+                            f"overwritten: {task.ring.overwritten}")
+        return False
+
+    def run(self):
+        self.logger.info("running")
+        error_count = 0
+        while self.do_run:
+            try:
+                task: rtask.RTask = self.task_ctrl.queue_denoise.get()
+                if task is None:
+                    break
+
+                if task.eos:
+                    if self.gate is not None:
+                        self.forward(task, self.gate.flush())
+                        self.carry = self.carry[:, :0]
+                    self.task_ctrl.queue_slice.put(task)
+                    continue
+
+                if task.ring is not None and not self.detach(task):
+                    continue
+
+                if task.param.sample_width != 2:
+                    # int16 pcm only, as the vad
+                    self.task_ctrl.queue_slice.put(task)
+                    continue
+
+                start = time.perf_counter()
+                samples = self.denoise(task)
+                self.task_ctrl.metrics.histogram("denoise_ms", "Time spent denoising one captured block") \
+                    .observe((time.perf_counter() - start) * 1000)
+                self.forward(task, samples)
+            except Exception as ex:
+                self.logger.error(ex, exc_info=True, stack_info=True)
+                if error_count > 3:
+                    self.logger.warning("error_count > 3, breaking...")
+                    break
+                error_count += 1
+        self.logger.info("end")
@@ -1,52 +1,107 @@
 import logging
 import threading
 
-import pyaudiowpatch as pyaudio
-import redis
-
-from src import rtask, rrecord, rslice, rtranscribe, rtranslate, rmanifest
-from src.common import sim
-from src.service.gui.root import RGuiRoot
+from src import rtask, rrecord, rdenoise, rslice, rtranscribe, rtranslate, rmanifest, rprocess
+from src.rpool import RModelPool
+from src.rstartup import RStartup
+from src.common import importutil, sim
+from src.service.metrics_ctrl import MetricsCtrl
 
 
 class RListener(threading.Thread):
     recorder: rrecord.Recorder = None
+    denoiser: rdenoise.RDenoiser = None
     slicer: rslice.RSlicer = None
     transcribers = []
     translators = []
     renderers = []
+    pool: RModelPool = None
 
     def __init__(
             self,
             cfg: dict,
-            py_audio: pyaudio.PyAudio = None):
+            py_audio=None):
         super().__init__()
+        # pyaudiowpatch.PyAudio, only the wasapi source needs one, it creates it when None
         self.py_audio = py_audio
 
-        if self.py_audio is None:
-            self.py_audio = pyaudio.PyAudio()
-
         self.cfg: dict = cfg
-        self.gui_root = RGuiRoot(cfg)
+        # headless: no tk at all, the caller runs the listener in its own thread instead of the gui mainloop
+        self.headless = not sim.getv(cfg, True, "gui", "active")
+        self.gui_root = None
+        if not self.headless:
+            self.gui_root = importutil.load("src.service.gui.root").RGuiRoot(cfg)
         self.task_ctrl = rtask.RTaskControl(
             cfg=cfg, gui_root=self.gui_root
         )
 
+        self.metrics = MetricsCtrl(self.task_ctrl)
+
         self.do_run = True
         self.lock = threading.Lock()
         self.logger = logging.getLogger('listener')
         self.configure()
 
     def configure(self):
+        self.metrics.configure()
+        self.warmup = sim.getv(self.cfg, True, "listener", "startup", "warmup")
+        self.backend = sim.getv(self.cfg, "thread", "transcriber", "backend")
+
+    def connect_redis(self):
         cfg_me = self.cfg.get("listener", {})
         redis_active = sim.getv(cfg_me, False, "redis")
         if not redis_active:
-            return
+            return None
         cfg_redis = self.cfg.get("redis", {})
         host = cfg_redis["host"]
         port = cfg_redis["port"]
-        self.task_ctrl.redis = redis.Redis(**cfg_redis)
+        client = importutil.load("redis").Redis(**cfg_redis)
+        try:
+            client.ping()
+        except Exception as ex:
+            self.logger.error(ex, exc_info=True, stack_info=True)
+            return None
+        self.task_ctrl.redis = client
         self.logger.info(f"redis client - {host}:{port}", )
+        return client
+
+    def load_model(self):
+        """ the model replicas of the transcribers, each warmed up with a dummy inference:
+        a pool shared by the transcriber threads, or one per worker process with the process backend
+        """
+        if self.backend == "process":
+            number = sim.getv(self.cfg, 1, "transcriber", "number")
+            workers = [rprocess.RProcessTranscriber(task_ctrl=self.task_ctrl, index=i + 1) for i in range(number)]
+            # the processes load side by side
+            for worker in workers:
+                worker.spawn(self.warmup)
+            for worker in workers:
+                worker.wait_ready()
+            return workers
+        self.pool = RModelPool(self.task_ctrl).configure().load(self.warmup)
+        return self.pool
+
+    def load_cutlet(self):
+        number = sim.getv(self.cfg, 1, "translator", "number")
+        for i in range(number):
+            # built outside shared(), which holds its lock while the factory runs
+            phoneme_ja = rtranslate.cutlet_of()
+            self.task_ctrl.shared(f"cutlet-{i + 1}", lambda: phoneme_ja)
+
+    def startup(self) -> RStartup:
+        """ the slow dependencies load in parallel, the translators start warming up their agents
+        as soon as they are built, see RStartup
+        """
+        startup = RStartup(self.cfg)
+        startup.submit("redis", self.connect_redis)
+        # the translators need the redis client for their cache, and pick up the preloaded dictionaries
+        after = ["redis"]
+        if sim.getv(self.cfg, False, "translator", "phoneme", "convert"):
+            startup.submit("cutlet", self.load_cutlet)
+            after.append("cutlet")
+        startup.submit("model", self.load_model)
+        startup.submit("translator", self.gen_translator, *after)
+        return startup
 
     def gen_recorder(self, start=True):
         self.recorder = rrecord.Recorder(
@@ -56,6 +111,15 @@ class RListener(threading.Thread):
         if start:
             self.recorder.start()
 
+    def gen_denoiser(self, start=True):
+        if not sim.getv(self.cfg, False, "denoiser", "active"):
+            return
+        self.denoiser = rdenoise.RDenoiser(
+            task_ctrl=self.task_ctrl,
+        )
+        if start:
+            self.denoiser.start()
+
     def gen_slicer(self, start=True):
         self.slicer = rslice.RSlicer(
             task_ctrl=self.task_ctrl,
@@ -63,15 +127,17 @@ class RListener(threading.Thread):
         if start:
             self.slicer.start()
 
-    def gen_transcriber(self, start=True):
-        model = None
+    def gen_transcriber(self, start=True, pool: RModelPool = None):
         number = sim.getv(self.cfg, 1, "transcriber", "number")
+        model = None
         for i in range(number):
             transcriber = rtranscribe.RTranscriber(
                 task_ctrl=self.task_ctrl,
                 index=i + 1,
             )
-            if model is None:
+            if pool is not None:
+                transcriber.pool = pool
+            elif model is None:
                 transcriber.init(True)
                 model = transcriber.model
             else:
@@ -80,6 +146,13 @@ class RListener(threading.Thread):
             if start:
                 transcriber.start()
 
+    def gen_workers(self, workers: list, start=True):
+        """ the process backend: the transcribers come already spawned from load_model """
+        for worker in workers:
+            self.transcribers.append(worker)
+            if start:
+                worker.start()
+
     def gen_translator(self, start=True):
         number = sim.getv(self.cfg, 1, "translator", "number")
         for i in range(number):
@@ -105,9 +178,13 @@ class RListener(threading.Thread):
     def terminiate(self):
         self.lock.acquire()
         try:
-            self.task_ctrl.queue_command.put("exit")
-            self.recorder.do_run = False
-            self.slicer.do_run = False
+            self.do_run = False
+            if self.recorder is not None:
+                self.recorder.do_run = False
+            if self.denoiser is not None:
+                self.denoiser.do_run = False
+            if self.slicer is not None:
+                self.slicer.do_run = False
             for transcriber in self.transcribers:
                 transcriber.do_run = False
             for translator in self.translators:
@@ -117,6 +194,11 @@ class RListener(threading.Thread):
             self.transcribers.clear()
             self.translators.clear()
             self.renderers.clear()
+            self.metrics.close()
+            if self.pool is not None:
+                self.logger.info(self.pool.report())
+            # wakes up the command loop too
+            self.task_ctrl.terminate()
         finally:
             self.lock.release()
 
@@ -126,20 +208,34 @@ class RListener(threading.Thread):
 
             self.lock.acquire()
             try:
-                self.gen_manifest()
-                self.gen_translator()
-                self.gen_transcriber()
-                self.gen_slicer()
-                self.gen_recorder()
+                self.metrics.start()
+                startup = self.startup()
+                try:
+                    self.gen_manifest()
+                    self.gen_slicer()
+                    self.gen_denoiser()
+                    if self.backend == "process":
+                        self.gen_workers(startup.result("model"))
+                    else:
+                        self.gen_transcriber(pool=startup.result("model"))
+                    startup.result("translator")
+                    # readiness barrier: nothing is captured before the model and the agents are warm
+                    startup.wait(*[translator.ready for translator in self.translators])
+                    self.gen_recorder()
+                finally:
+                    startup.close()
             finally:
                 self.lock.release()
+            self.logger.info(startup.report())
+            self.logger.info(importutil.report())
 
             while self.do_run:
                 cmd: rtask.RCommand = self.task_ctrl.queue_command.get()
                 if cmd is None or len(cmd.action) <= 0:
                     continue
                 if cmd.action == "exit":
-                    self.task_ctrl.terminate()
+                    if self.do_run:
+                        self.terminiate()
                     break
 
         except Exception as e:
@@ -149,5 +245,7 @@ class RListener(threading.Thread):
             self.logger.info("end")
 
     def gui_mainloop(self):
+        if self.gui_root is None:
+            return
         self.gui_root.init()
         self.gui_root.run_mainloop()
@@ -36,6 +36,9 @@ class RManifest(threading.Thread):
         self.console.init(**cfg_console)
         self.barrage.init(**cfg_barrage)
         self.file.init(**cfg_file)
+        if self.barrage.active and self.task_ctrl.gui_root is None:
+            self.logger.warning("headless: barrage disabled")
+            self.barrage.active = False
 
         textattr_default = None
         for manifest_type in ["default", "transcribe", "phoneme", "translated", "performance"]:
@@ -66,8 +69,27 @@ class RManifest(threading.Thread):
             font_size=textattr.size,
             timing=task.info.sequence,
             priority=priority,
+            # partial hypotheses of an utterance are replaced in place by the next one, then by the final text
+            key=f"{task.info.sequence}-{manifest_type}",
         )
 
+    def manifest_partial(self, task, priority):
+
+        # the final transcription of the utterance is under way
+        if task.stream is not None and task.stream.final:
+            return
+
+        text = task.text_transcribe
+
+        if text is None or len(text) <= 0:
+            return
+
+        if self.console.active and self.console.partial:
+            print(f"[~] {text}")
+
+        if self.barrage.partial:
+            self.show_barrage("transcribe", task, text, priority)
+
     def manifest_transcribe(self, task, priority):
 
         text = task.text_transcribe
@@ -106,28 +128,27 @@ class RManifest(threading.Thread):
 
     def manifest_performance(self, task, priority):
 
+        task.info.time_set("render")
+        spans = task.info.spans()
+
+        latency = self.task_ctrl.metrics.histogram("stage_latency_ms", "Latency of the pipeline stages", ("stage",))
+        for name, value in spans.items():
+            latency.observe(value, stage=name)
+
         do_console = self.console.active and self.console.performance
         do_barrage = self.barrage.active and self.barrage.performance
 
         if not (do_console or do_barrage):
             return
 
-        task.info.time_set("manifest")
-        # task.info.time_set_as_str("manifest_str")
-        task.info.time_diff("translate", "manifest", store="manifest")
-        task.info.time_diff(head="create", tail="manifest", store="all")
-
-        diff_slice = task.info.time_elapsed_get("slice")
-        diff_transcribe = task.info.time_elapsed_get("transcribe")
-        diff_translate = task.info.time_elapsed_get("translate")
-        diff_manifest = task.info.time_elapsed_get("manifest")
-        diff_all = diff_slice + diff_transcribe + diff_translate + diff_manifest
-
         pending_slice = self.task_ctrl.queue_slice.qsize()
         pending_transcribe = self.task_ctrl.queue_transcribe.qsize()
-        perf = f"duration: {task.text_info.duration} | " \
-               f"all: {diff_all} | slice: {diff_slice} | transcribe: {diff_transcribe} | " \
-               f"translate: {diff_translate} | manifest: {diff_manifest} | " \
+        # capture -> slice of each chunk of the slice, from the oldest to the newest
+        chunks = task.info.child_spans("slice")
+        chunk_slice = f"{max(chunks)}..{min(chunks)}" if len(chunks) > 0 else "0"
+        perf = f"duration: {task.text_info.duration} | all: {spans.get('all', 0)} | " + \
+               "".join(f"{name}: {spans.get(name, 0)} | " for name in rtask.RInfo.SPANS if name != "all") + \
+               f"chunks: {len(chunks)} | chunk_slice: {chunk_slice} | " + \
                f"slice_pending: {pending_slice} | transcribe_pending: {pending_transcribe} | "
 
         if do_console:
@@ -166,6 +187,15 @@ class RManifest(threading.Thread):
         while self.do_run:
             try:
                 task: rtask.RTask = self.task_ctrl.queue_manifest.get()
+                if task is None:
+                    # keep the terminate signal for the other renderers
+                    self.task_ctrl.queue_manifest.put(None)
+                    break
+
+                if task.partial:
+                    self.manifest_partial(task, 1)
+                    continue
+
                 text_target = task.text_translate
                 if text_target is None or len(text_target) <= 0:
                     text_target = task.text_transcribe
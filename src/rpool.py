@@ -0,0 +1,194 @@
+import contextlib
+import logging
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from src import rtask
+from src.common import audioutil, importutil, sim
+
+
+class RModelReplica:
+    """ One WhisperModel and its placement, leased by the transcribers for one pass at a time.
+
+    num_workers is the number of passes ctranslate2 runs side by side on the model,
+    more leases than that wait on its internal lock.
+    """
+
+    def __init__(self, index: int, cfg: dict):
+        self.index = index
+        self.name = f"{index}"
+        self.model_size = sim.getv(cfg, "large-v3", "model_size")
+        self.download_root = sim.getv(cfg, "./models", "download_root")
+        self.local_files_only = sim.getv(cfg, True, "local_files_only")
+        self.device = sim.getv(cfg, "cuda", "device")
+        self.device_index = sim.getv(cfg, 0, "device_index")
+        self.compute_type = sim.getv(cfg, "default", "compute_type")
+        # 0: ctranslate2's default, 4 or OMP_NUM_THREADS
+        self.cpu_threads = sim.getv(cfg, 0, "cpu_threads")
+        self.num_workers = max(1, sim.getv(cfg, 1, "num_workers"))
+        self.model = None
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.tasks = 0
+        # seconds spent in passes, a pass still running counts from busy_since
+        self.busy = 0.0
+        self.busy_since = {}
+        self.created = time.monotonic()
+
+    def placement(self) -> str:
+        placement = f"{self.device}:{self.device_index} {self.compute_type} | workers: {self.num_workers}"
+        if self.device == "cpu":
+            placement += f" | threads: {self.cpu_threads}"
+        return placement
+
+    def load(self) -> 'RModelReplica':
+        faster_whisper = importutil.load("faster_whisper")
+        self.model = faster_whisper.WhisperModel(
+            model_size_or_path=self.model_size,
+            device=self.device,
+            device_index=self.device_index,
+            compute_type=self.compute_type,
+            cpu_threads=self.cpu_threads,
+            num_workers=self.num_workers,
+            download_root=self.download_root,
+            local_files_only=self.local_files_only,
+        )
+        self.created = time.monotonic()
+        return self
+
+    def warmup(self) -> 'RModelReplica':
+        """ one greedy pass over a second of silence, the kernels are compiled / loaded before the first slice """
+        audio = numpy.zeros(audioutil.MODEL_SAMPLE_RATE, dtype=numpy.float32)
+        segments, _ = self.model.transcribe(audio=audio, beam_size=1)
+        for _ in segments:
+            pass
+        return self
+
+    def load_factor(self) -> float:
+        return self.in_flight / self.num_workers
+
+    def busy_time(self, now: float) -> float:
+        with self.lock:
+            return self.busy + sum(now - since for since in self.busy_since.values())
+
+
+def replicas_of(cfg: dict) -> typing.List[RModelReplica]:
+    """ the replicas of transcriber.replicas, not loaded yet """
+    transcriber_cfg = sim.getv(cfg, {}, "transcriber")
+    entries = sim.getv(transcriber_cfg, [], "replicas") or [{}]
+    base = {key: value for key, value in transcriber_cfg.items() if key != "replicas"}
+    replicas = []
+    for entry in entries:
+        for _ in range(max(1, entry.get("count", 1))):
+            replicas.append(RModelReplica(len(replicas) + 1, {**base, **entry}))
+    return replicas
+
+
+class RModelPool:
+    """ The model replicas of the transcribers: each pass leases the least loaded replica.
+
+    transcriber.replicas lists the replicas, each entry overrides the transcriber settings
+    (device, device_index, compute_type, cpu_threads, num_workers, model_size) and may be
+    repeated `count` times. Without replicas, the transcriber settings make a single one.
+    """
+
+    def __init__(self, task_ctrl: rtask.RTaskControl):
+        self.task_ctrl = task_ctrl
+        self.replicas: typing.List[RModelReplica] = []
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        # utilization between two collects
+        self.collected = {}
+        self.logger = logging.getLogger('model-pool')
+
+    def configure(self) -> 'RModelPool':
+        self.replicas = replicas_of(self.task_ctrl.cfg)
+        self.task_ctrl.metrics.collector("model_pool", self.collect)
+        return self
+
+    def load(self, warmup: bool = True) -> 'RModelPool':
+        """ the replicas load side by side, an error of any of them is raised """
+
+        def load(replica: RModelReplica):
+            start = time.perf_counter()
+            replica.load()
+            if warmup:
+                replica.warmup()
+            self.logger.info(f"replica {replica.name} | {replica.placement()} | "
+                             f"ready in {time.perf_counter() - start:.3f}s")
+
+        with ThreadPoolExecutor(max_workers=len(self.replicas), thread_name_prefix="model-pool") as executor:
+            list(executor.map(load, self.replicas))
+        return self
+
+    def capacity(self) -> int:
+        return sum(replica.num_workers for replica in self.replicas)
+
+    def acquire(self) -> RModelReplica:
+        """ the replica with the fewest passes in flight per worker, waiting while they are all full """
+        with self.available:
+            while True:
+                replica = min(self.replicas, key=lambda r: (r.load_factor(), r.tasks))
+                if replica.in_flight < replica.num_workers:
+                    break
+                self.available.wait()
+            replica.in_flight += 1
+            replica.tasks += 1
+        with replica.lock:
+            replica.busy_since[threading.get_ident()] = time.monotonic()
+        return replica
+
+    def release(self, replica: RModelReplica):
+        with replica.lock:
+            replica.busy += time.monotonic() - replica.busy_since.pop(threading.get_ident())
+        with self.available:
+            replica.in_flight -= 1
+            self.available.notify()
+
+    @contextlib.contextmanager
+    def lease(self):
+        replica = self.acquire()
+        try:
+            yield replica
+        finally:
+            self.release(replica)
+
+    def utilization(self) -> dict:
+        """ busy time over wall time per worker, since the previous call, by replica name """
+        now = time.monotonic()
+        ret = {}
+        for replica in self.replicas:
+            busy = replica.busy_time(now)
+            prev_time, prev_busy = self.collected.get(replica.name, (replica.created, 0.0))
+            self.collected[replica.name] = (now, busy)
+            elapsed = now - prev_time
+            ret[replica.name] = (busy - prev_busy) / elapsed / replica.num_workers if elapsed > 0 else 0.0
+        return ret
+
+    def collect(self, registry):
+        utilization = self.utilization()
+        in_flight = registry.gauge("model_replica_in_flight", "Passes running on the replica", ("replica",))
+        usage = registry.gauge(
+            "model_replica_utilization", "Busy share of the replica's workers since the last scrape", ("replica",))
+        busy = registry.gauge("model_replica_busy_seconds", "Seconds the replica spent in passes", ("replica",))
+        tasks = registry.gauge("model_replica_tasks", "Passes leased on the replica", ("replica",))
+        now = time.monotonic()
+        for replica in self.replicas:
+            in_flight.set(replica.in_flight, replica=replica.name)
+            usage.set(round(utilization[replica.name], 4), replica=replica.name)
+            busy.set(round(replica.busy_time(now), 3), replica=replica.name)
+            tasks.set(replica.tasks, replica=replica.name)
+
+    def report(self) -> str:
+        now = time.monotonic()
+        items = []
+        for replica in self.replicas:
+            elapsed = now - replica.created
+            usage = replica.busy_time(now) / elapsed / replica.num_workers if elapsed > 0 else 0.0
+            items.append(f"replica {replica.name} ({replica.placement()}): {replica.tasks} passes, {usage:.1%} busy")
+        return " | ".join(items)
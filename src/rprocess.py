@@ -0,0 +1,211 @@
+""" Process backend of the transcribers (transcriber.backend: process).
+
+Each RProcessTranscriber thread feeds one worker process which owns its own model replica,
+so the decoding, the segment iteration and the filtering run outside of the GIL of the app.
+The samples of a slice go by reference when they are in the shared audio arena, else through
+a shared memory block of their own, only names, offsets and lengths are pickled;
+the text comes back on a queue.
+"""
+import io
+import logging
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+import numpy
+
+from src import rtask
+from src.common import sim
+from src.common.arena import AudioArena
+from src.rpool import replicas_of
+from src.rtranscribe import RTranscriber, segments_of
+
+
+def serve(cfg: dict, index: int, warmup: bool, requests, results):
+    """ the worker process: load the replica, then transcribe the requests until None """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(name)s] %(levelname)s - %(message)s")
+    logging.getLogger("faster_whisper").setLevel(logging.ERROR)
+    logger = logging.getLogger(f"transcriber-process-{index}")
+    try:
+        replicas = replicas_of(cfg)
+        replica = replicas[(index - 1) % len(replicas)].load()
+        if warmup:
+            replica.warmup()
+    except Exception as ex:
+        results.put({"ready": False, "error": repr(ex)})
+        return
+    results.put({"ready": True, "placement": replica.placement()})
+
+    prompt_default = sim.getv(cfg, "transcriber here", "transcriber", "prompt")
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        try:
+            results.put(transcribe(replica.model, request, prompt_default))
+        except Exception as ex:
+            logger.error(ex, exc_info=True)
+            results.put({"error": repr(ex)})
+
+
+# arenas of the app attached by this worker process, by name
+arenas = {}
+
+
+def transcribe(model, request: dict, prompt_default: str) -> dict:
+    block = None
+    audio = request.get("audio", None)
+    if audio is not None:
+        audio = io.BytesIO(audio)
+    elif "arena" in request:
+        # a view over the app's arena, the app holds the block until the result is back
+        name = request["arena"]
+        if name not in arenas:
+            arenas[name] = AudioArena.attach(name, request["capacity"])
+        audio = arenas[name].view(request["offset"], request["length"])
+    else:
+        # attached, not copied, the parent unlinks the block once the result is back
+        block = shared_memory.SharedMemory(name=request["block"])
+        audio = numpy.ndarray((request["length"],), dtype=numpy.float32, buffer=block.buf)
+    try:
+        segments, info = segments_of(
+            model=model,
+            audio=audio,
+            beam_size=request["beam_size"],
+            prompt=request["prompt"],
+            echo=prompt_default,
+        )
+        text = ""
+        start = end = 0
+        for segment in segments:
+            text += segment.text
+            start = segment.start
+            end = segment.end
+    finally:
+        del audio
+        if block is not None:
+            block.close()
+    return {
+        "text": text,
+        "start": start,
+        "end": end,
+        "language": info.language,
+        "language_probability": info.language_probability,
+        "duration": info.duration,
+    }
+
+
+class RProcessTranscriber(RTranscriber):
+    """ Drop-in for RTranscriber: same queues, deadlines and delivery, the model runs in a worker process.
+
+    Not supported by this backend: batching (one slice per request) and streaming partials
+    (dropped, the final slice of the utterance is transcribed whole).
+    """
+
+    def __init__(
+            self,
+            task_ctrl: rtask.RTaskControl,
+            index: int = 1,
+    ) -> None:
+        super().__init__(task_ctrl=task_ctrl, index=index)
+        self.process: multiprocessing.Process = None
+        self.requests = None
+        self.results = None
+
+    def spawn(self, warmup: bool = True) -> 'RProcessTranscriber':
+        # spawn: a fresh interpreter, no cuda context or locks inherited from the app
+        context = multiprocessing.get_context("spawn")
+        self.requests = context.SimpleQueue()
+        self.results = context.Queue()
+        self.process = context.Process(
+            target=serve,
+            args=(self.task_ctrl.cfg, self.index, warmup, self.requests, self.results),
+            name=f"transcriber-process-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        return self
+
+    def receive(self) -> dict:
+        """ the next message of the worker process, an error once it is gone """
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(f"transcriber process {self.index} exited: {self.process.exitcode}")
+
+    def wait_ready(self) -> 'RProcessTranscriber':
+        message = self.receive()
+        if not message.get("ready", False):
+            raise RuntimeError(f"transcriber process {self.index}: {message.get('error', '')}")
+        self.logger.info(f"process {self.process.pid} ready | {message.get('placement', '')}")
+        return self
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+
+    def remote(self, task: rtask.RTask, beam_size: int) -> str:
+        request = {
+            "beam_size": beam_size,
+            "prompt": self.prompt,
+        }
+        block = None
+        arena = self.task_ctrl.arena
+        if task.block is not None and len(arena.name) > 0:
+            # the samples are in the shared arena already, no copy
+            request["arena"], request["offset"], request["length"] = task.block.handle()
+            request["capacity"] = arena.capacity
+        elif task.samples is not None:
+            samples = task.samples
+            block = shared_memory.SharedMemory(create=True, size=max(samples.nbytes, 1))
+            numpy.ndarray(samples.shape, dtype=numpy.float32, buffer=block.buf)[:] = samples
+            request["block"] = block.name
+            request["length"] = len(samples)
+        else:
+            request["audio"] = task.audio
+        try:
+            self.requests.put(request)
+            result = self.receive()
+        finally:
+            if block is not None:
+                block.close()
+                block.unlink()
+        if "error" in result:
+            raise RuntimeError(f"transcriber process {self.index}: {result['error']}")
+        task.text_info = rtask.RTextInfo(
+            language=result["language"],
+            language_probability=result["language_probability"],
+            duration=result["duration"],
+        )
+        task.text_start = result["start"]
+        task.text_end = result["end"]
+        return result["text"]
+
+    def handle(self, task: rtask.RTask):
+        if self.audio_of(task) is None or task.partial:
+            return
+        task.info.time_set("transcribe_start")
+        action = self.deadline_of(task)
+        if action == "drop":
+            return
+
+        # stale slices are decoded greedily, to catch up with the audio
+        beam_size = 1 if action == "degrade" else self.beam_size
+        self.deliver(task, self.remote(task, beam_size))
+
+    def run(self):
+        if self.batch_active:
+            self.logger.warning("batching is not supported by the process backend, one slice per request")
+            self.batch_active = False
+        try:
+            super().run()
+        finally:
+            self.stop()
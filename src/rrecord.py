@@ -1,12 +1,15 @@
 import logging
-import queue
+import sys
 import threading
 import time
+import wave
 
-import pyaudiowpatch as pyaudio
-import webrtcvad
+import numpy
 
 from src import rtask
+from src.common import sim
+from src.common.audioutil import CaptureConverter
+from src.common.ringbuffer import RingBuffer
 
 
 class ARException(Exception):
@@ -21,11 +24,240 @@ class InvalidDevice(ARException):
     ...
 
 
+class AudioSource:
+    """ Where the Recorder reads its pcm from.
+
+    read(frames) returns up to `frames` frames of interleaved pcm, b"" once the source is exhausted.
+    live sources (a device) pace themselves, the others are paced by the Recorder at its replay speed.
+    """
+    live = False
+
+    def __init__(self, cfg: dict):
+        self.cfg = cfg
+        self.sample_rate = 16000
+        self.sample_width = 2
+        self.sample_channels = 1
+        self.logger = logging.getLogger(f'source-{self.name()}')
+
+    @classmethod
+    def name(cls) -> str:
+        return cls.__name__.lower().replace("source", "")
+
+    def open(self):
+        pass
+
+    def read(self, frames: int) -> bytes:
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class WasapiSource(AudioSource):
+    """ loopback of the default speakers, windows only """
+    live = True
+
+    def __init__(self, cfg: dict, p_audio=None):
+        super().__init__(cfg)
+        self.py_audio = p_audio
+        self.device = None
+        self.stream = None
+        self.data_format = None
+        self.chunk_size = sim.getv(cfg, 65536, "chunk_size")
+        self.sample_rate = sim.getv(cfg, 48000, "sample_rate")
+        self.sample_channels = 0
+
+    def get_default_wasapi_device(self):
+        import pyaudiowpatch as pyaudio
+
+        try:  # Get default WASAPI info
+            wasapi_info = self.py_audio.get_host_api_info_by_type(pyaudio.paWASAPI)
+        except OSError:
+            raise WASAPINotFound("Looks like WASAPI is not available on the system")
+
+        # Get default WASAPI speakers
+        sys_default_speakers = self.py_audio.get_device_info_by_index(wasapi_info["defaultOutputDevice"])
+
+        if not sys_default_speakers["isLoopbackDevice"]:
+            for loopback in self.py_audio.get_loopback_device_info_generator():
+                if sys_default_speakers["name"] in loopback["name"]:
+                    return loopback
+            else:
+                raise InvalidDevice(
+                    "Default loopback output device not found.\n\nRun `python -m pyaudiowpatch` to check available "
+                    "devices")
+
+    def open(self):
+        import pyaudiowpatch as pyaudio
+
+        if self.py_audio is None:
+            self.py_audio = pyaudio.PyAudio()
+        self.data_format = sim.getv(self.cfg, pyaudio.paInt16, "data_format")
+        self.sample_width = self.py_audio.get_sample_size(self.data_format)
+
+        if self.device is None:
+            self.device = self.get_default_wasapi_device()
+        if self.sample_rate is None or self.sample_rate <= 0:
+            self.sample_rate = int(self.device["defaultSampleRate"])
+        self.sample_channels = self.device["maxInputChannels"]
+
+        self.logger.info(f"init | device: {self.device}")
+
+        self.stream = self.py_audio.open(format=self.data_format,
+                                         channels=self.sample_channels,
+                                         rate=self.sample_rate,
+                                         frames_per_buffer=self.chunk_size,
+                                         input=True,
+                                         input_device_index=self.device["index"],
+                                         )
+
+    def read(self, frames: int) -> bytes:
+        return self.stream.read(frames, exception_on_overflow=False)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+
+
+class FileSource(AudioSource):
+    """ pcm wav files with the wave module, anything else PyAV can decode as s16 """
+
+    def __init__(self, cfg: dict):
+        super().__init__(cfg)
+        self.path = sim.getv(cfg, "", "file", "path")
+        # 0: the file's own rate
+        self.sample_rate = sim.getv(cfg, 0, "file", "sample_rate")
+        self.wave_file: wave.Wave_read = None
+        self.container = None
+        self.decoded = None
+        self.pending = bytearray()
+
+    def open(self):
+        if self.path is None or len(self.path) <= 0:
+            raise Exception("recorder.file.path is not set")
+        try:
+            self.wave_file = wave.open(self.path, "rb")
+        except (wave.Error, EOFError):
+            self.wave_file = None
+        if self.wave_file is not None and self.wave_file.getsampwidth() == 2 and \
+                self.sample_rate in (0, self.wave_file.getframerate()):
+            self.sample_rate = self.wave_file.getframerate()
+            self.sample_channels = self.wave_file.getnchannels()
+            self.logger.info(f"wave | {self.path} | {self.sample_rate}Hz x {self.sample_channels}")
+            return
+        if self.wave_file is not None:
+            self.wave_file.close()
+            self.wave_file = None
+
+        import av
+
+        self.container = av.open(self.path)
+        stream = self.container.streams.audio[0]
+        if self.sample_rate <= 0:
+            self.sample_rate = stream.rate
+        self.sample_channels = 1 if stream.channels == 1 else 2
+        resampler = av.AudioResampler(
+            format="s16",
+            layout="mono" if self.sample_channels == 1 else "stereo",
+            rate=self.sample_rate,
+        )
+        self.decoded = self.decode(stream, resampler)
+        self.logger.info(f"av | {self.path} | {self.sample_rate}Hz x {self.sample_channels}")
+
+    def decode(self, stream, resampler):
+        for frame in self.container.decode(stream):
+            for out in resampler.resample(frame):
+                yield out.to_ndarray().tobytes()
+        # drain the resampler
+        for out in resampler.resample(None):
+            yield out.to_ndarray().tobytes()
+
+    def read(self, frames: int) -> bytes:
+        if self.wave_file is not None:
+            return self.wave_file.readframes(frames)
+        size = frames * self.sample_channels * self.sample_width
+        while len(self.pending) < size:
+            chunk = next(self.decoded, None)
+            if chunk is None:
+                break
+            self.pending.extend(chunk)
+        ret = bytes(self.pending[:size])
+        del self.pending[:size]
+        return ret
+
+    def close(self):
+        if self.wave_file is not None:
+            self.wave_file.close()
+            self.wave_file = None
+        if self.container is not None:
+            self.container.close()
+            self.container = None
+
+
+class PipeSource(AudioSource):
+    """ raw s16le pcm on stdin, e.g. ffmpeg -i input -f s16le -ac 1 -ar 16000 - | python -m src.app """
+
+    def __init__(self, cfg: dict):
+        super().__init__(cfg)
+        self.sample_rate = sim.getv(cfg, 16000, "pipe", "sample_rate")
+        self.sample_channels = sim.getv(cfg, 1, "pipe", "channels")
+
+    def read(self, frames: int) -> bytes:
+        size = frames * self.sample_channels * self.sample_width
+        chunks = []
+        while size > 0:
+            chunk = sys.stdin.buffer.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+
+class SynthSource(AudioSource):
+    """ bursts of a harmonic tone over faint noise, alternating with silence, reproducible from the seed """
+
+    def __init__(self, cfg: dict):
+        super().__init__(cfg)
+        self.sample_rate = sim.getv(cfg, 16000, "synth", "sample_rate")
+        self.sample_channels = sim.getv(cfg, 1, "synth", "channels")
+        self.seconds = sim.getv(cfg, 60, "synth", "seconds")
+        self.speech = sim.getv(cfg, 2.0, "synth", "speech")
+        self.silence = sim.getv(cfg, 1.0, "synth", "silence")
+        self.frequency = sim.getv(cfg, 220, "synth", "frequency")
+        self.rng = numpy.random.default_rng(sim.getv(cfg, 0, "synth", "seed"))
+        self.position = 0
+
+    def read(self, frames: int) -> bytes:
+        total = int(self.seconds * self.sample_rate)
+        frames = min(frames, total - self.position)
+        if frames <= 0:
+            return b""
+        t = (self.position + numpy.arange(frames)) / self.sample_rate
+        self.position += frames
+        period = self.speech + self.silence
+        voiced = (t % period) < self.speech
+        # a syllable-like envelope on a few harmonics
+        envelope = 0.5 + 0.5 * numpy.sin(2 * numpy.pi * 4 * t)
+        tone = sum(numpy.sin(2 * numpy.pi * self.frequency * k * t) / k for k in range(1, 5))
+        signal = numpy.where(voiced, 0.3 * envelope * tone, 0) + self.rng.normal(0, 0.001, frames)
+        pcm = numpy.clip(signal * 32767, -32768, 32767).astype(numpy.int16)
+        return numpy.repeat(pcm, self.sample_channels).tobytes()
+
+
+SOURCES = {
+    source.name(): source for source in (WasapiSource, FileSource, PipeSource, SynthSource)
+}
+
+
 class Recorder(threading.Thread):
 
     def __init__(self,
-                 p_audio: pyaudio.PyAudio,
-                 task_ctrl: rtask.RTaskControl,
+                 p_audio=None,
+                 task_ctrl: rtask.RTaskControl = None,
+                 source: AudioSource = None,
                  ):
 
         super().__init__()
@@ -33,27 +265,34 @@ class Recorder(threading.Thread):
         self.py_audio = p_audio
         self.task_ctrl = task_ctrl
 
-        # 设置 VAD 的敏感度。参数是一个 0 到 3 之间的整数。0 表示对非语音最不敏感，3 最敏感。
-        self.vad = webrtcvad.Vad()
-        self.vad.set_mode(1)
+        self.source = source
+        self.source_name = "wasapi"
+        self.opened = False
+        # replay speed of the sources that are not live: 1 real time, N times faster, 0 as fast as possible
+        self.speed = 1.0
+        # tasks waiting for the slicer before an unpaced replay waits for it
+        self.backlog = 50
+
+        # captured pcm -> mono at convert_rate before the ring (convert_rate 0: as captured)
+        self.convert_rate = 16000
+        self.convert_channels = "mix"
+        self.convert_pick = 0
+        self.convert_taps = 32
+        self.converter: CaptureConverter = None
+        # converted pcm short of a whole frame
+        self.carry = bytearray()
 
-        self.stream = None
-        self.device = None
-
-        self.sample_rate = 48000
-        self.data_format = pyaudio.paInt16
-        self.output_channels = 0
-        self.chunk_size = 512
         self.frame_size = 0
-
         self.frame_duration = 10
+        # frames read from the source so far
+        self.frames = 0
 
-        self.output_data = queue.Queue()
-
-        self.frame_cache = []
-        self.frame_lock = threading.Lock()
+        # captured pcm lives in the ring, downstream stages get views over it
+        self.ring: RingBuffer = None
+        self.ring_seconds = 30
         self.flush_interval = 0.1
         self.flush_thread = None
+        self.flush_stop = threading.Event()
 
         self.logger = logging.getLogger(f'recorder')
 
@@ -65,11 +304,25 @@ class Recorder(threading.Thread):
 
         r_cfg = cfg.get("recorder", {})
 
-        self.sample_rate = r_cfg.get("sample_rate", 48000)
-        self.data_format = r_cfg.get("data_format", pyaudio.paInt16)
-        self.chunk_size = r_cfg.get("chunk_size", 65536)
         self.flush_interval = r_cfg.get("flush_interval", 0.1)
         self.frame_duration = r_cfg.get("frame_duration", 10)
+        self.ring_seconds = r_cfg.get("ring_seconds", 30)
+        self.speed = r_cfg.get("speed", 1)
+        self.backlog = r_cfg.get("backlog", 50)
+        self.convert_rate = sim.getv(r_cfg, 16000, "convert", "sample_rate")
+        self.convert_channels = sim.getv(r_cfg, "mix", "convert", "channels")
+        self.convert_pick = sim.getv(r_cfg, 0, "convert", "pick")
+        self.convert_taps = sim.getv(r_cfg, 32, "convert", "taps")
+
+        if self.source is None:
+            self.source_name = r_cfg.get("source", "wasapi").lower()
+            source_cls = SOURCES.get(self.source_name, None)
+            if source_cls is None:
+                raise Exception(f"unknown recorder source: {self.source_name}, expected one of {list(SOURCES)}")
+            if source_cls is WasapiSource:
+                self.source = WasapiSource(r_cfg, self.py_audio)
+            else:
+                self.source = source_cls(r_cfg)
 
     def __enter__(self) -> 'Recorder':
         pass
@@ -77,74 +330,74 @@ class Recorder(threading.Thread):
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
         self.close_stream()
 
-    def get_default_wasapi_device(self):
-        try:  # Get default WASAPI info
-            wasapi_info = self.py_audio.get_host_api_info_by_type(pyaudio.paWASAPI)
-        except OSError:
-            raise WASAPINotFound("Looks like WASAPI is not available on the system")
-
-        # Get default WASAPI speakers
-        sys_default_speakers = self.py_audio.get_device_info_by_index(wasapi_info["defaultOutputDevice"])
-
-        if not sys_default_speakers["isLoopbackDevice"]:
-            for loopback in self.py_audio.get_loopback_device_info_generator():
-                if sys_default_speakers["name"] in loopback["name"]:
-                    return loopback
-            else:
-                raise InvalidDevice(
-                    "Default loopback output device not found.\n\nRun `python -m pyaudiowpatch` to check available "
-                    "devices")
-
     def get_sample_width(self):
-        return self.py_audio.get_sample_size(self.data_format)
+        return self.source.sample_width
 
     def get_sample_rate(self):
-        if self.sample_rate is None or self.sample_rate <= 0:
-            if self.device is not None:
-                self.sample_rate = int(self.device["defaultSampleRate"])
-        return self.sample_rate
+        if self.converter is not None:
+            return self.converter.rate_des
+        return self.source.sample_rate
 
     def get_frame_size(self):
         sample_rate = self.get_sample_rate()
         self.frame_size = (sample_rate * self.frame_duration) // 1000
         return self.frame_size
 
-    def get_sample_channels(self):
-        if self.output_channels is None or self.output_channels <= 0:
-            if self.device is not None:
-                self.output_channels = self.device["maxInputChannels"]
-        return self.output_channels
+    def get_read_size(self):
+        """ frames read from the source at once: one frame at the source's own rate """
+        return (self.source.sample_rate * self.frame_duration) // 1000
 
-    def stream_callback(self, in_data, frame_count, time_info, status):
-        """Write frames and return PA flag"""
-        self.output_data.put(in_data)
-        return in_data, pyaudio.paContinue
+    def get_sample_channels(self):
+        if self.converter is not None:
+            return 1
+        return self.source.sample_channels
+
+    def init_converter(self) -> CaptureConverter:
+        self.converter = None
+        self.carry = bytearray()
+        rate = self.convert_rate if self.convert_rate > 0 else self.source.sample_rate
+        if self.source.sample_width != 2:
+            self.logger.warning(f"convert | int16 pcm only, sample width: {self.source.sample_width}, kept as captured")
+            return None
+        if rate == self.source.sample_rate and self.source.sample_channels <= 1:
+            return None
+        self.converter = CaptureConverter(
+            rate_src=self.source.sample_rate,
+            channels_src=self.source.sample_channels,
+            rate_des=rate,
+            mode=self.convert_channels,
+            pick=self.convert_pick,
+            taps=self.convert_taps,
+        )
+        self.logger.info(f"convert | {self.source.sample_rate}Hz x {self.source.sample_channels} -> {rate}Hz x 1 | "
+                         f"channels: {self.convert_channels}")
+        return self.converter
+
+    def convert(self, data: bytes, frame_bytes: int) -> bytes:
+        """ the whole frames of the converted data, the rest waits for the next read """
+        self.carry += self.converter.process(data)
+        count = len(self.carry) // frame_bytes * frame_bytes
+        ret = bytes(self.carry[:count])
+        del self.carry[:count]
+        return ret
+
+    def init_ring(self) -> RingBuffer:
+        frame_bytes = self.get_frame_size() * self.get_sample_channels() * self.get_sample_width()
+        capacity = max(1, self.ring_seconds * 1000 // self.frame_duration)
+        self.ring = RingBuffer(frame_bytes=frame_bytes, capacity=capacity)
+        self.logger.info(f"ring buffer | frame: {frame_bytes} bytes | capacity: {capacity} frames")
+        return self.ring
 
     def init(self):
 
         self.close_stream()
 
-        if self.device is None:
-            self.device = self.get_default_wasapi_device()
+        self.source.open()
+        self.opened = True
+        self.init_converter()
 
-        device_index = self.device["index"]
-        device_channels = self.get_sample_channels()
-        sample_rate = self.get_sample_rate()
-
-        # self.p.print_detailed_system_info()
-
-        self.logger.info(f"init | device: {self.device}")
-
-        self.stream = self.py_audio.open(format=self.data_format,
-                                         channels=device_channels,
-                                         rate=sample_rate,
-                                         frames_per_buffer=self.chunk_size,
-                                         input=True,
-                                         input_device_index=device_index,
-                                         # stream_callback=stream_callback
-                                         )
-
-        return self.stream
+        self.logger.info(f"init | source: {self.source.name()} | "
+                         f"{self.get_sample_rate()}Hz x {self.get_sample_channels()} | speed: {self.speed}")
 
     def flush(self, callback=None):
 
@@ -152,100 +405,164 @@ class Recorder(threading.Thread):
         sample_width = self.get_sample_width()
         sample_channels = self.get_sample_channels()
 
-        while self.do_run:
-            time.sleep(self.flush_interval)
+        while self.do_run and not self.flush_stop.wait(self.flush_interval):
+            self.drain(sample_rate, sample_width, sample_channels, callback)
 
-            all_frames = None
-            self.frame_lock.acquire()
-            try:
-                if len(self.frame_cache) <= 0:
-                    continue
-
-                all_frames = b''.join(self.frame_cache)
-                self.frame_cache = []
-            finally:
-                self.frame_lock.release()
-
-            if all_frames is None or len(all_frames) <= 0:
-                continue
-
-            self.to_slice(all_frames, sample_rate, sample_width, sample_channels, callback)
+    def drain(self, sample_rate, sample_width, sample_channels, callback=None):
+        # one task per contiguous range of the ring, at most two per flush
+        while self.do_run:
+            seq, count = self.ring.read(timeout=0)
+            if count <= 0:
+                break
+            self.to_slice(seq, count, sample_rate, sample_width, sample_channels, callback)
 
     def to_slice(
             self,
-            frame,
+            seq,
+            count,
             sample_rate,
             sample_width,
             sample_channels,
             callback=None
     ):
 
+        frame = self.ring.frames(seq, count)
         task = rtask.RTask(
             audio=frame,
             sample_rate=sample_rate,
             sample_width=sample_width,
             sample_channels=sample_channels,
         )
+        if self.source.live:
+            task.ring = self.ring
+            task.ring_seq = seq
+        else:
+            # a replay may run ahead of the slicer by more than the ring holds
+            task.audio = bytes(frame)
 
         if callback is not None:
             r = callback(frame, task)
             if r is not None and r is False:
                 return
 
-        self.task_ctrl.queue_slice.put(task)
+        self.task_ctrl.queue_capture.put(task)
+
+    def to_eos(self, sample_rate, sample_width, sample_channels):
+        """ the source is exhausted: the slicer ends the open utterance """
+        task = rtask.RTask(
+            audio=b"",
+            sample_rate=sample_rate,
+            sample_width=sample_width,
+            sample_channels=sample_channels,
+        )
+        task.eos = True
+        self.task_ctrl.queue_capture.put(task)
+
+    def pace(self, start: float, frames: int):
+        """ hold a replay to its speed, and an unpaced one to what the slicer keeps up with """
+        if self.source.live:
+            return
+        if self.speed > 0:
+            due = start + frames * self.frame_duration / 1000 / self.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            return
+        while self.do_run and self.task_ctrl.queue_capture.qsize() >= self.backlog:
+            time.sleep(self.frame_duration / 1000)
 
     def record(self, callback=None):
 
         self.do_run = True
 
+        if self.ring is None:
+            self.init_ring()
+
         if self.flush_interval > 0:
+            self.flush_stop.clear()
             self.flush_thread = threading.Thread(target=self.flush, args=(callback,))
             self.flush_thread.start()
 
-        frame_size = self.get_frame_size()
+        read_size = self.get_read_size()
+        frame_bytes = self.ring.frame_bytes
         sample_rate = self.get_sample_rate()
         sample_width = self.get_sample_width()
         sample_channels = self.get_sample_channels()
+        start = time.monotonic()
+        self.frames = 0
+        eos = False
         while self.do_run:
-            frame = self.stream.read(frame_size, exception_on_overflow=False)
+            frame = self.source.read(read_size)
             if not frame:
-                continue
+                if self.source.live:
+                    continue
+                if len(self.carry) > 0:
+                    # the tail of a converted file or pipe
+                    self.ring.write(bytes(self.carry) + bytes(frame_bytes - len(self.carry)))
+                    self.carry = bytearray()
+                    self.frames += 1
+                eos = True
+                break
+            if self.converter is not None:
+                frame = self.convert(frame, frame_bytes)
+                if len(frame) <= 0:
+                    continue
+            elif len(frame) % frame_bytes != 0:
+                # the tail of a file or pipe
+                frame = frame + bytes(frame_bytes - len(frame) % frame_bytes)
+
+            self.ring.write(frame)
+            self.frames += len(frame) // frame_bytes
+            self.pace(start, self.frames)
 
             if self.flush_interval > 0:
-                self.frame_lock.acquire()
-                try:
-                    self.frame_cache.append(frame)
-                finally:
-                    self.frame_lock.release()
                 continue
 
-            self.to_slice(frame, sample_rate, sample_width, sample_channels, callback)
+            seq, count = self.ring.read(timeout=0)
+            if count > 0:
+                self.to_slice(seq, count, sample_rate, sample_width, sample_channels, callback)
+
+        if self.flush_thread is not None:
+            self.flush_stop.set()
+            self.flush_thread.join()
+            self.flush_thread = None
+        if eos:
+            self.drain(sample_rate, sample_width, sample_channels, callback)
+            self.to_eos(sample_rate, sample_width, sample_channels)
+            self.logger.info(f"end of stream | {self.frames * self.frame_duration / 1000:.1f}s "
+                             f"in {time.monotonic() - start:.1f}s")
 
         self.do_run = False
 
     def run(self):
         self.logger.info("running")
         try:
-            if self.stream is None:
+            if not self.opened:
                 self.init()
             self.record()
         except Exception as e:
             self.logger.error(e, exc_info=True, stack_info=True)
         finally:
+            self.close_stream()
             self.logger.info("end")
 
     def stop_stream(self):
-        self.stream.stop_stream()
+        if isinstance(self.source, WasapiSource) and self.source.stream is not None:
+            self.source.stream.stop_stream()
 
     def start_stream(self):
-        self.stream.start_stream()
+        if isinstance(self.source, WasapiSource) and self.source.stream is not None:
+            self.source.stream.start_stream()
 
     def close_stream(self):
-        if self.stream is not None:
-            self.stream.stop_stream()
-            self.stream.close()
-            self.stream = None
+        if self.opened:
+            self.source.close()
+            self.opened = False
 
     @property
     def stream_status(self):
-        return "closed" if self.stream is None else "stopped" if self.stream.is_stopped() else "running"
+        if not self.opened:
+            return "closed"
+        if isinstance(self.source, WasapiSource) and self.source.stream.is_stopped():
+            return "stopped"
+        return "running"
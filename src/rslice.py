@@ -1,14 +1,15 @@
 import io
 import logging
 import threading
+import time
 import typing
 import wave
 
-import noisereduce
 import numpy
-import webrtcvad
 
 from src import rtask
+from src.common import audioutil, importutil, sim
+from src.common.vadutil import BlockVad
 
 
 # from pyAudioAnalysis import audioSegmentation
@@ -24,19 +25,51 @@ class RSlicer(threading.Thread):
 
         self.do_run = True
 
-        self.vad = webrtcvad.Vad()
-        self.vad.set_mode(1)
+        self.vad: BlockVad = None
 
         self.buffer_len = 10
         self.speech_len = 5
         self.non_speech_len = 5
+        # sliding window (in frames) the speech / non speech counts are taken over
+        self.window_len = 5
+        self.frame_duration = 10
+        # forced cut: utterances are cut at the quietest frame among the last cut_search_len frames
+        # once they reach max_len frames, overlap_len frames before the cut are repeated in the next slice
+        self.max_len = 0
+        self.cut_search_len = 100
+        self.overlap_len = 20
+        # streaming: emit the open utterance every stream_interval frames for a partial transcription
+        self.stream_active = False
+        self.stream_interval = 50
+        # ms after capture a slice goes stale, see RInfo.deadline_set
+        self.max_lag = 0
         self.silence_ratio = 0.5
         self.slice_mode = ""
 
         self.denoise_ratio_of_fragment = 0
         self.denoise_ratio_of_speech = 0
 
-        self.__frames: typing.List[bytes] = []
+        # pcm: hand float32 mono 16k samples to the transcriber, wave: keep the wav container on task.audio
+        self.pcm = True
+        self.wave = False
+
+        # (task, frame begin, frame end) chunks of the pending utterance,
+        # the task audio may be a view over the recorder ring
+        self.__frames: typing.List[typing.Tuple[rtask.RTask, int, int]] = []
+        self.__frames_len = 0
+        # energy (dBFS) of each pending frame, searched for the forced cut
+        self.__energy = numpy.zeros(0, dtype=numpy.float32)
+        # the forced cut the last slice ended with, the next one starts with it
+        self.__cut: rtask.RCut = None
+        self.__stream: rtask.RStream = None
+        self.__stream_pending = 0
+        # speech mask of the current window, carried across blocks
+        self.__window = numpy.zeros(0, dtype=bool)
+        self.__triggered = False
+        # sequence of the open utterance, taken when it triggers, carried by its partials and its slice
+        self.__sequence = 0
+        # utterances dropped as the ring overwrote them before they were sliced
+        self.dropped = 0
 
         self.logger = logging.getLogger(f'slicer')
 
@@ -47,9 +80,33 @@ class RSlicer(threading.Thread):
         self.buffer_len = cfg.get("buffer_len", 10)
         self.speech_len = cfg.get("speech_len", 5)
         self.non_speech_len = cfg.get("non_speech_len", 5)
+        self.window_len = sim.getv(cfg, 0, "vad", "window")
+        if self.window_len <= 0:
+            self.window_len = max(self.speech_len, self.non_speech_len)
+        self.max_len = cfg.get("max_len", 0)
+        self.cut_search_len = cfg.get("cut_search_len", 100)
+        self.overlap_len = cfg.get("overlap_len", 20)
+        self.frame_duration = sim.getv(self.task_ctrl.cfg, 10, "recorder", "frame_duration")
+        cfg_stream = sim.getv(self.task_ctrl.cfg, {}, "transcriber", "stream")
+        self.stream_active = sim.getv(cfg_stream, False, "active")
+        self.stream_interval = max(1, sim.getv(cfg_stream, 500, "interval") // self.frame_duration)
+        if 0 < self.max_len <= self.cut_search_len + self.overlap_len:
+            raise Exception(f"slicer max_len {self.max_len} must exceed cut_search_len + overlap_len")
+        self.max_lag = sim.getv(self.task_ctrl.cfg, 0, "deadline", "max_lag")
+        self.vad = BlockVad(
+            mode=sim.getv(cfg, 1, "vad", "mode"),
+            energy_floor=sim.getv(cfg, -55, "vad", "energy_floor"),
+            zcr_max=sim.getv(cfg, 0, "vad", "zcr_max"),
+        )
         self.denoise_ratio_of_fragment = cfg.get("denoise_ratio_of_fragment", 0)
         self.denoise_ratio_of_speech = cfg.get("denoise_ratio_of_speech", 0)
+        if sim.getv(self.task_ctrl.cfg, False, "denoiser", "active"):
+            # the streaming denoiser cleaned the audio already
+            self.denoise_ratio_of_fragment = 0
+            self.denoise_ratio_of_speech = 0
         self.slice_mode = cfg.get("slice_mode", "vad").lower()
+        self.pcm = cfg.get("pcm", True)
+        self.wave = cfg.get("wave", False)
         return self
 
     def wave_format(
@@ -109,36 +166,325 @@ class RSlicer(threading.Thread):
         try:
             # librosa may get some numpy.float error, fix librosa utils to do the hack
             data = numpy.frombuffer(data_bytes, dtype=numpy.int16)
-            return noisereduce.reduce_noise(
+            # noisereduce pulls librosa in, only when denoising is on
+            noisereduce = importutil.load("noisereduce")
+            ret = noisereduce.reduce_noise(
                 y=data,
                 prop_decrease=denoise_ratio,
                 # use_torch=True,
                 sr=int(sample_rate)
             )
+            # keep the int16 layout, frames are cut by byte offsets downstream
+            return numpy.asarray(ret).astype(numpy.int16, copy=False)
         except Exception as ex:
             self.logger.error(f"{name} - noisereduce.reduce_noise failed: {ex}", stack_info=True)
+            return data_bytes
+
+    def frames_append(self, task: rtask.RTask, begin: int, end: int, energy: numpy.ndarray):
+        if end <= begin:
+            return
+        self.__frames.append((task, begin, end))
+        self.__frames_len += end - begin
+        self.__energy = numpy.concatenate((self.__energy, energy[begin:end]))
+
+    def frames_trim(self, keep: int):
+        """ keep only the last keep frames """
+        if self.__frames_len <= keep:
+            return
+        kept = []
+        total = 0
+        for task, begin, end in reversed(self.__frames):
+            if total + end - begin >= keep:
+                kept.append((task, end - (keep - total), end))
+                total = keep
+                break
+            kept.append((task, begin, end))
+            total += end - begin
+        kept.reverse()
+        self.__frames = kept
+        self.__frames_len = total
+        self.__energy = self.__energy[len(self.__energy) - total:]
+
+    def frames_slice(self, begin: int, end: int) -> typing.List[typing.Tuple[rtask.RTask, int, int]]:
+        """ chunks covering pending frames [begin, end) """
+        ret = []
+        offset = 0
+        for task, chunk_begin, chunk_end in self.__frames:
+            size = chunk_end - chunk_begin
+            lo = max(begin - offset, 0)
+            hi = min(end - offset, size)
+            if lo < hi:
+                ret.append((task, chunk_begin + lo, chunk_begin + hi))
+            offset += size
+        return ret
+
+    def frames_valid(self) -> bool:
+        """ False when the ring overwrote the head of the pending utterance: it is dropped, not transcribed.
+        Called after the frames are copied out of the ring, as RDenoiser.detach does
+        """
+        if len(self.__frames) <= 0:
+            return True
+        head = self.__frames[0][0]
+        if head.ring is None or head.ring.check(head.ring_seq):
+            return True
+        self.dropped += 1
+        self.task_ctrl.metrics.counter("slice_dropped_total", "Utterances dropped by the slicer", ("reason",)) \
+            .inc(reason="overwritten")
+        self.logger.warning(
+            f"utterance overwritten in the ring buffer, dropped: {self.dropped} | "
+            f"overwritten: {head.ring.overwritten} | ring dropped: {head.ring.dropped}")
+        self.__frames.clear()
+        self.__frames_len = 0
+        self.__energy = self.__energy[:0]
+        self.__stream = None
+        self.__stream_pending = 0
+        self.__cut = None
+        return False
+
+    def frames_chunks(self, frame_bytes: int) -> typing.List[memoryview]:
+        """ views over the pending frames, no copy, see frames_valid """
+        chunks = []
+        for task, begin, end in self.__frames:
+            chunks.append(memoryview(task.audio).cast("B")[begin * frame_bytes:end * frame_bytes])
+        return chunks
+
+    def frames_join(self, frame_bytes: int) -> bytes:
+        return b''.join(self.frames_chunks(frame_bytes))
+
+    def model_input(self, task: rtask.RTask, frame_bytes: int, data_bytes=None):
+        """ (samples, arena block) of the pending frames, or of data_bytes when given.
+
+        With an arena, at the model sample rate, the pcm is converted straight from the frames
+        into the arena: the only copy of the utterance. At another rate it is resampled first,
+        then copied in. Without an arena, or when it is full, the samples are a plain array.
+        """
+        arena = self.task_ctrl.arena
+        param = task.param
+        if data_bytes is not None:
+            # bytes, or the int16 array of the denoiser
+            chunks = [memoryview(data_bytes).cast("B")]
+        else:
+            chunks = self.frames_chunks(frame_bytes)
+        direct = param.sample_rate == audioutil.MODEL_SAMPLE_RATE
+        if arena is not None and direct:
+            pcm_bytes = param.sample_width * param.sample_channels
+            block = arena.alloc(sum(len(chunk) for chunk in chunks) // pcm_bytes)
+            if block is not None:
+                view = block.view()
+                pos = 0
+                for chunk in chunks:
+                    count = len(chunk) // pcm_bytes
+                    audioutil.to_model_input_into(
+                        data=chunk,
+                        out=view[pos:pos + count],
+                        sample_width=param.sample_width,
+                        sample_channels=param.sample_channels,
+                    )
+                    pos += count
+                return view, block
+
+        samples = audioutil.to_model_input(
+            data=chunks[0] if len(chunks) == 1 else b''.join(chunks),
+            sample_rate=param.sample_rate,
+            sample_width=param.sample_width,
+            sample_channels=param.sample_channels,
+        )
+        block = arena.alloc(len(samples)) if arena is not None and not direct else None
+        if block is None:
+            return samples, None
+        view = block.view()
+        view[:] = samples
+        return view, block
+
+    def window_find(self, mask: numpy.ndarray, pos: int, stop: int) -> int:
+        """ first frame in [pos, stop) where the window satisfies the current state's transition, -1 if none """
+        history = self.__window
+        full = numpy.concatenate((history, mask[pos:stop]))
+        cumsum = numpy.concatenate(([0], numpy.cumsum(full)))
+        tail = numpy.arange(len(history) + 1, len(full) + 1)
+        head = numpy.maximum(tail - self.window_len, 0)
+        speech = cumsum[tail] - cumsum[head]
+        if not self.__triggered:
+            hit = speech >= self.speech_len
+        else:
+            hit = (tail - head) - speech >= self.non_speech_len
+        if not hit.any():
+            self.__window = full[-(self.window_len - 1):] if self.window_len > 1 else full[:0]
+            return -1
+        return pos + int(numpy.argmax(hit))
+
+    def info_of_frames(self) -> rtask.RInfo:
+        """ a slice is the parent span of the captured chunks it is made of, in the head's sequence """
+        info = rtask.RInfo()
+        info.sequence_set(self.__sequence)
+        # the chunks of one captured block are contiguous: adopt each block's info once
+        prev = None
+        for task, _, _ in self.__frames:
+            if task.info is not prev:
+                info.adopt(task.info)
+                prev = task.info
+        info.deadline_set(self.max_lag)
+        return info
+
+    def emit(self, task: rtask.RTask, frame_bytes: int, forced: bool = False):
+        data_bytes = None
+        # the pcm model input is converted from the frames themselves, see model_input
+        if self.denoise_ratio_of_speech > 0 or self.wave or not self.pcm:
+            data_bytes = self.frames_join(frame_bytes)
+        if self.denoise_ratio_of_speech > 0:
+            data_bytes = self.denoise(
+                data_bytes=data_bytes,
+                sample_rate=task.param.sample_rate,
+                denoise_ratio=self.denoise_ratio_of_speech,
+                name="speech"
+            )
+
+        slice_task = rtask.RTask(
+            audio=None,
+            sample_rate=task.param.sample_rate,
+            sample_width=task.param.sample_width,
+            sample_channels=task.param.sample_channels,
+            info=self.info_of_frames(),
+        )
+        slice_task.info.time_set("slice")
+        if self.pcm:
+            slice_task.samples, slice_task.block = self.model_input(task, frame_bytes, data_bytes)
+        if self.wave or not self.pcm:
+            slice_task.audio = self.wave_format(
+                task=task,
+                data_bytes=data_bytes,
+            )
+        # checked once the frames are copied out of the ring: an overwrite during the copy shows as well
+        if not self.frames_valid():
+            slice_task.release()
+            return
+
+        slice_task.cut_head = self.__cut
+        self.__cut = None
+        if forced:
+            self.__cut = slice_task.cut_tail = rtask.RCut(overlap=self.overlap_len * self.frame_duration / 1000)
+
+        slice_task.stream = self.__stream
+        self.__stream = None
+        self.__stream_pending = 0
+
+        self.__frames.clear()
+        self.__frames_len = 0
+        self.__energy = self.__energy[:0]
+
+        self.task_ctrl.queue_transcribe.put(slice_task)
+
+    def emit_partial(self, task: rtask.RTask, frame_bytes: int):
+        """ hand the open utterance so far to the transcriber, it keeps growing until emit() """
+        if self.__stream is None:
+            self.__stream = rtask.RStream()
+        self.__stream_pending = 0
+
+        partial_task = rtask.RTask(
+            audio=None,
+            sample_rate=task.param.sample_rate,
+            sample_width=task.param.sample_width,
+            sample_channels=task.param.sample_channels,
+            info=self.info_of_frames(),
+        )
+        partial_task.info.time_set("slice")
+        partial_task.samples, partial_task.block = self.model_input(task, frame_bytes)
+        if not self.frames_valid():
+            partial_task.release()
+            return
+        partial_task.stream = self.__stream
+        partial_task.partial = True
+        self.task_ctrl.queue_transcribe.put(partial_task)
+
+    def cut(self, task: rtask.RTask, frame_bytes: int):
+        """ utterance too long: emit up to the quietest recent frame and stay triggered with the overlap """
+        search_begin = max(self.__frames_len - self.cut_search_len, 0)
+        cut = search_begin + int(numpy.argmin(self.__energy[search_begin:self.__frames_len])) + 1
+        carry = max(cut - self.overlap_len, 0)
+
+        chunks_carry = self.frames_slice(carry, self.__frames_len)
+        energy_carry = self.__energy[carry:]
+
+        self.__frames = self.frames_slice(0, cut)
+        self.__frames_len = cut
+        self.emit(task, frame_bytes, forced=True)
+
+        self.__frames = chunks_carry
+        self.__frames_len = len(energy_carry)
+        self.__energy = energy_carry
+
+        self.sequence_next()
+
+    def sequence_next(self):
+        # unique even for two utterances triggered within the same ms
+        self.__sequence = max(time.time_ns() // rtask.NANO_TO_MILLI, self.__sequence + 1)
+
+    def slice_block(self, task: rtask.RTask):
+        """ classify the whole block at once, then walk the speech mask from one transition to the next """
+        mask, energy = self.vad.classify(
+            data=task.audio,
+            sample_rate=task.param.sample_rate,
+            sample_width=task.param.sample_width,
+            sample_channels=task.param.sample_channels,
+            frame_duration=self.frame_duration,
+        )
+        frame_samples = task.param.sample_rate * self.frame_duration // 1000
+        frame_bytes = frame_samples * task.param.sample_channels * task.param.sample_width
+
+        pos = 0
+        count = len(mask)
+        while pos < count:
+            stop = count
+            if self.__triggered and self.max_len > 0:
+                stop = min(count, pos + max(self.max_len - self.__frames_len, 0))
+            hit = self.window_find(mask, pos, stop)
+            end = stop if hit < 0 else hit + 1
+            self.frames_append(task, pos, end, energy)
+            if not self.__triggered:
+                self.frames_trim(self.buffer_len)
+            elif self.stream_active and self.pcm:
+                self.__stream_pending += end - pos
+                if hit < 0 and self.__stream_pending >= self.stream_interval:
+                    self.emit_partial(task, frame_bytes)
+            pos = end
+            if hit < 0:
+                if self.__triggered and 0 < self.max_len <= self.__frames_len:
+                    self.cut(task, frame_bytes)
+                continue
+            # counts restart after each transition, as the watcher deque was cleared
+            self.__window = numpy.zeros(0, dtype=bool)
+            if not self.__triggered:
+                self.__triggered = True
+                self.sequence_next()
+            else:
+                self.__triggered = False
+                self.emit(task, frame_bytes)
+
+    def flush(self, task: rtask.RTask):
+        """ end of stream: emit the open utterance, whatever the trailing silence """
+        if self.__triggered and self.__frames_len > 0:
+            frame_samples = task.param.sample_rate * self.frame_duration // 1000
+            self.emit(task, frame_samples * task.param.sample_channels * task.param.sample_width)
+        self.__frames.clear()
+        self.__frames_len = 0
+        self.__energy = self.__energy[:0]
+        self.__window = numpy.zeros(0, dtype=bool)
+        self.__triggered = False
+        self.__cut = None
+        self.logger.info("end of stream")
 
     def slice_by_vad(self):
         error_count = 0
 
-        # watcher = collections.deque(maxlen=self.buffer_len)
-        triggered = False
-
-        task_head = None
-
-        speech_count = 0
-        non_speech_count = 0
-
         while self.do_run:
             try:
                 task: rtask.RTask = self.task_ctrl.queue_slice.get()
                 if task is None:
                     break
 
-                if task_head is None:
-                    task.info.time_set("slice")
-                    task.info.sequence_set()
-                    task_head = task
+                if task.eos:
+                    self.flush(task)
+                    continue
 
                 if self.denoise_ratio_of_fragment > 0:
                     task.audio = self.denoise(
@@ -148,54 +494,7 @@ class RSlicer(threading.Thread):
                         name="fragment"
                     )
 
-                try:
-                    is_speech = self.vad.is_speech(task.audio, task.param.sample_rate)
-                except Exception as ex:
-                    is_speech = False
-                    self.logger.error(f"vad.is_speech() failed - speech len {len(task.audio)}- {ex}")
-                    self.logger.error(ex, exc_info=True, stack_info=True)
-
-                # watcher.append(is_speech)
-
-                if is_speech:
-                    speech_count += 1
-                else:
-                    non_speech_count += 1
-
-                self.__frames.append(task.audio)
-                if not triggered:
-                    # num_voiced = len([x for x in watcher if x])
-                    if speech_count >= self.speech_len:
-                        triggered = True
-                        # watcher.clear()
-                        speech_count = 0
-                        non_speech_count = 0
-                        self.__frames = self.__frames[-self.buffer_len:]
-                else:
-                    # num_unvoiced = len([x for x in watcher if not x])
-                    if non_speech_count >= self.non_speech_len:
-                        triggered = False
-
-                        data_bytes = b''.join(self.__frames)
-                        if self.denoise_ratio_of_speech > 0:
-                            data_bytes = self.denoise(
-                                data_bytes=data_bytes,
-                                sample_rate=task.param.sample_rate,
-                                denoise_ratio=self.denoise_ratio_of_speech,
-                                name="speech"
-                            )
-
-                        task.audio = self.wave_format(
-                            task=task,
-                            data_bytes=data_bytes,
-                        )
-                        self.__frames.clear()
-
-                        task_head.info.time_diff("slice", "create", store="slice")
-                        task.info = task_head.info
-                        task_head = None
-
-                        self.task_ctrl.queue_transcribe.put(task)
+                self.slice_block(task)
 
             except Exception as ex:
                 self.logger.error(ex, exc_info=True, stack_info=True)
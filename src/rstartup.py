@@ -0,0 +1,71 @@
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+from src.common import sim
+
+
+class RStartup:
+    """ Runs the slow startup jobs (model load, agent warmups, dictionaries, redis connect) side by side,
+    so the time to the first subtitle is the slowest of them instead of their sum.
+
+    A job may depend on others, it starts once they are done. wait() is the readiness barrier.
+    """
+
+    def __init__(self, cfg: dict):
+        self.cfg = cfg
+        self.parallel = sim.getv(cfg, True, "listener", "startup", "parallel")
+        self.timeout = sim.getv(cfg, 120, "listener", "startup", "timeout")
+        self.jobs = {}
+        self.elapsed = {}
+        self.started = time.perf_counter()
+        # sequential startup: one worker, the jobs run in submission order
+        self.executor: ThreadPoolExecutor = None
+        self.logger = logging.getLogger('startup')
+
+    def submit(self, name: str, job, *after: str) -> Future:
+        """ run job() once the jobs named in `after` are done """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=8 if self.parallel else 1, thread_name_prefix="startup")
+        dependencies = [self.jobs[dependency] for dependency in after]
+
+        def run():
+            for dependency in dependencies:
+                dependency.exception()
+            start = time.perf_counter()
+            try:
+                return job()
+            finally:
+                self.elapsed[name] = time.perf_counter() - start
+                self.logger.info(f"{name} ready in {self.elapsed[name]:.3f}s")
+
+        self.jobs[name] = self.executor.submit(run)
+        return self.jobs[name]
+
+    def result(self, name: str):
+        """ the result of a job, waiting for it, its exception is raised here """
+        return self.jobs[name].result()
+
+    def wait(self, *events) -> bool:
+        """ readiness barrier: all the jobs done and the events set, False on timeout """
+        deadline = time.monotonic() + self.timeout
+        for name, job in self.jobs.items():
+            try:
+                job.exception(timeout=max(0.0, deadline - time.monotonic()))
+            except TimeoutError:
+                self.logger.warning(f"{name} not ready after {self.timeout}s")
+                return False
+        for event in events:
+            if not event.wait(max(0.0, deadline - time.monotonic())):
+                self.logger.warning(f"not ready after {self.timeout}s")
+                return False
+        return True
+
+    def report(self) -> str:
+        jobs = " | ".join(f"{name}: {elapsed:.3f}s" for name, elapsed in self.elapsed.items())
+        return f"ready in {time.perf_counter() - self.started:.3f}s | {jobs}"
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
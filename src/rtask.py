@@ -1,17 +1,24 @@
-import datetime
 import logging
 import multiprocessing
 import os
 import queue
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, Union
+from typing import TYPE_CHECKING, Dict, List, Union
 
-import redis
+import numpy
 
-from src.service.gui.root import RGuiRoot
+from src.common import audioutil, sim
+from src.common.arena import ArenaBlock, AudioArena
+from src.common.metrics import Registry
 from src.service.gui.share import RTextAttr
 
+if TYPE_CHECKING:
+    # tkinter stays out of headless runs, redis out of the runs without it
+    import redis
+    from src.service.gui.root import RGuiRoot
+
 NANO_TO_MILLI = 1_000_000
 
 class RBot:
@@ -49,38 +56,57 @@ class RParam:
 
 
 class RInfo:
-    times = {}
-    elapsed = {}
-    sequence = 0
+    """ Per-task trace, monotonic ns timestamps of the pipeline stages:
+    capture, slice, transcribe_start, transcribe_end, translate_start, translate_end, render
+
+    A slice merged from several captured chunks is the parent span of their infos: it keeps each child's
+    capture stamp (not the info itself), its own capture time is the earliest of them, see child_spans().
+    """
+
+    __slots__ = ("times", "elapsed", "sequence", "children", "deadline")
+
+    # name -> (head stage, tail stage), the *_wait spans are the time spent in the queues
+    SPANS = {
+        "slice": ("capture", "slice"),
+        "transcribe_wait": ("slice", "transcribe_start"),
+        "transcribe": ("transcribe_start", "transcribe_end"),
+        "translate_wait": ("transcribe_end", "translate_start"),
+        "translate": ("translate_start", "translate_end"),
+        "manifest": ("translate_end", "render"),
+        "all": ("capture", "render"),
+    }
 
     def __init__(self):
-        self.time_set("create")
-        # self.time_set_as_str("create_str")
-
-    def time_set(self, name: str):
-        self.times[name] = time.time_ns() // NANO_TO_MILLI
-
-    def time_elapsed(self, name: str, src: int = 0):
-        if src <= 0:
-            src = time.time_ns()
-        self.elapsed[name] = round(src // NANO_TO_MILLI - self.times[name])
-
-    def time_set_as_str(self, name: str):
-        self.times[name] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-
-    def time_get(self, name: str, raise_if_none=False):
-        ret = self.times[name]
+        self.times: Dict[str, int] = {}
+        self.elapsed: Dict[str, int] = {}
+        self.sequence = 0
+        # capture stamps (monotonic ns) of the child chunks, see adopt()
+        self.children: List[int] = []
+        # monotonic ns after which the task is stale, 0: never
+        self.deadline = 0
+        self.time_set("capture")
+
+    def time_set(self, name: str, ns: int = 0):
+        self.times[name] = ns if ns > 0 else time.monotonic_ns()
+
+    def time_get(self, name: str, raise_if_none=False) -> int:
+        ret = self.times.get(name, None)
         if ret is None:
             if raise_if_none:
                 raise Exception(f"Time {name} is None")
             return 0
         return ret
 
-    def time_elapsed_get(self, name: str):
-        return self.elapsed.get(name, None)
+    def time_elapsed_get(self, name: str) -> int:
+        return self.elapsed.get(name, 0)
 
     def time_diff(self, head: str, tail: str, store: str = None, raise_if_none=False):
-        diff = self.time_get(tail, raise_if_none) - self.time_get(head, raise_if_none)
+        """ ms from stage head to stage tail, None when one of them is missing """
+        time_head = self.time_get(head, raise_if_none)
+        time_tail = self.time_get(tail, raise_if_none)
+        if time_head <= 0 or time_tail <= 0:
+            return None
+        diff = (time_tail - time_head) // NANO_TO_MILLI
         if diff < 0:
             logging.warning(f"Time diff {head} -> {tail} is negative: {diff}")
 
@@ -89,12 +115,95 @@ class RInfo:
 
         return diff
 
+    def spans(self) -> Dict[str, int]:
+        """ store and return the elapsed ms of every span whose both ends are stamped """
+        for name, (head, tail) in self.SPANS.items():
+            self.time_diff(head, tail, store=name)
+        return self.elapsed
+
+    def adopt(self, child: 'RInfo'):
+        # a merged parent hands its own children on
+        if len(child.children) > 0:
+            self.children.extend(child.children)
+        else:
+            self.children.append(child.time_get("capture"))
+        capture = child.time_get("capture")
+        if 0 < capture < self.time_get("capture"):
+            self.time_set("capture", capture)
+
+    def child_spans(self, tail: str = "slice") -> List[int]:
+        """ ms from the capture of each child chunk to stage tail of the parent, empty before tail """
+        time_tail = self.time_get(tail)
+        if time_tail <= 0:
+            return []
+        return [(time_tail - capture) // NANO_TO_MILLI for capture in self.children if capture > 0]
+
+    def deadline_set(self, max_lag: int):
+        """ the task is stale max_lag ms after its audio was captured, 0 disables """
+        self.deadline = self.time_get("capture") + max_lag * NANO_TO_MILLI if max_lag > 0 else 0
+
+    def expired(self) -> bool:
+        return 0 < self.deadline < time.monotonic_ns()
+
     def sequence_set(self, sequence: int = 0):
         if sequence <= 0:
             sequence = time.time_ns() // NANO_TO_MILLI
         self.sequence = sequence
 
 
+class RTextInfo:
+    """ Minimal stand-in for faster_whisper's TranscriptionInfo, used where the
+    transcription did not go through WhisperModel.transcribe (e.g. batched passes)
+    """
+
+    def __init__(
+            self,
+            language: str = "",
+            language_probability: float = 0,
+            duration: float = 0,
+    ):
+        self.language = language
+        self.language_probability = language_probability
+        self.duration = duration
+
+
+class RStream:
+    """ Incremental transcription state of one open utterance, shared by its partial tasks and its final task.
+
+    committed: text of the words that stayed stable across enough passes
+    offset: seconds of the utterance audio covered by the committed words, never decoded again
+    history: word lists of the latest passes over the audio after offset
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.committed = ""
+        self.offset = 0.0
+        self.history = []
+        self.final = False
+
+
+class RCut:
+    """ A forced cut between two slices, the head of the slice after it repeats `overlap` seconds of the one before.
+
+    The slice before the cut resolves it with its text once transcribed, or with nothing once dropped;
+    the slice after it waits for that, then drops the words transcribed twice.
+    """
+
+    __slots__ = ("overlap", "text", "done")
+
+    def __init__(self, overlap: float):
+        self.overlap = overlap
+        self.text = ""
+        self.done = threading.Event()
+
+    def resolve(self, text: str = ""):
+        if self.done.is_set():
+            return
+        self.text = text
+        self.done.set()
+
+
 class RCommand:
 
     def __init__(
@@ -115,6 +224,7 @@ class RManifestUnit:
     transcribe: bool = True
     translated: bool = True
     performance: bool = False
+    partial: bool = False
     text: Dict[str, any] = {}
     textattrs: Dict[str, RTextAttr] = {}
 
@@ -125,6 +235,7 @@ class RManifestUnit:
             transcribe: bool = True,
             translated: bool = True,
             performance: bool = False,
+            partial: bool = False,
             path: str = "",
             text=None
     ) -> 'RManifestUnit':
@@ -137,6 +248,7 @@ class RManifestUnit:
         self.transcribe = transcribe
         self.translated = translated
         self.performance = performance
+        self.partial = partial
         return self
 
 
@@ -148,10 +260,25 @@ class RTask:
             sample_rate: int,
             sample_width: int,
             sample_channels: int,
-            param=RParam(),
-            info=None,
+            param: RParam = None,
+            info: RInfo = None,
     ):
         self.audio = audio
+        # float32 mono samples at the model sample rate, fed to the model without any wav round-trip
+        self.samples = None
+        # when samples is a view over the audio arena: its block, see release()
+        self.block: ArenaBlock = None
+        # when audio is a view over the recorder ring: the ring and the sequence of the first frame
+        self.ring = None
+        self.ring_seq = 0
+        # forced cuts: the one this slice starts with, shared with the previous slice, and the one it ends with
+        self.cut_head: RCut = None
+        self.cut_tail: RCut = None
+        # streaming: state of the open utterance, partial tasks carry a hypothesis to be replaced later
+        self.stream: RStream = None
+        self.partial = False
+        # end of stream: a replay source is exhausted, no audio
+        self.eos = False
         self.text_transcribe = ""
         self.text_translate = ""
         self.text_phoneme = ""
@@ -161,6 +288,8 @@ class RTask:
         self.text_end = "",
 
         self.param = param
+        if self.param is None:
+            self.param = RParam()
         self.param.sample_rate = sample_rate
         self.param.sample_width = sample_width
         self.param.sample_channels = sample_channels
@@ -169,19 +298,133 @@ class RTask:
         if self.info is None:
             self.info = RInfo()
 
+    def release(self):
+        """ the samples are not needed anymore, their arena block goes back """
+        if self.block is None:
+            return
+        self.block.release()
+        self.block = None
+        self.samples = None
+
+    def cut_resolve(self, text: str = ""):
+        """ done with this slice, the one after its forced cut may go on, see RCut """
+        if self.cut_tail is not None:
+            self.cut_tail.resolve(text)
+
+
+def merge_tasks(prev: RTask, task: RTask, max_samples: int = 0):
+    """ the task standing for prev followed by task, None if they can not be merged
+    or if the merged samples would exceed max_samples (0: no limit)
+    """
+    if prev.stream is not None and prev.stream is task.stream:
+        # a newer hypothesis, or the final pass, of the same utterance supersedes a partial
+        if not prev.partial:
+            return None
+        prev.release()
+        return task
+    if prev.partial or task.partial or prev.stream is not None or task.stream is not None:
+        return None
+    if prev.samples is None or task.samples is None or prev.audio is not None or task.audio is not None:
+        return None
+    if len(prev.text_transcribe) > 0 or len(task.text_transcribe) > 0:
+        return None
+    # a forced cut repeats the end of prev at the head of task
+    cut = task.cut_head
+    skip = round(cut.overlap * audioutil.MODEL_SAMPLE_RATE) if cut is not None and cut is prev.cut_tail else 0
+    if 0 < max_samples < len(prev.samples) + len(task.samples) - skip:
+        return None
+    samples = numpy.concatenate((prev.samples, task.samples[skip:]))
+    prev.release()
+    task.release()
+    prev.samples = samples
+    # the cut between them is gone, the one after task now follows prev
+    prev.cut_resolve()
+    prev.cut_tail = task.cut_tail
+    task.cut_tail = None
+    prev.info.adopt(task.info)
+    prev.info.deadline = min(prev.info.deadline, task.info.deadline)
+    return prev
+
+
+class RQueue(queue.Queue):
+    """ queue.Queue bounded to maxsize, with a policy for a put on a full queue:
+
+    block: wait for room, as queue.Queue does
+    drop_oldest: drop the task waiting the longest, a stale utterance is worth less than a fresh one
+    drop_newest: drop the task being put
+    merge: merge the task into the last waiting one (see merge_tasks), drop_oldest if they can't be merged,
+           or if the merged slice would be longer than merge_max samples
+
+    None, the terminate signal, is never dropped nor blocked.
+    """
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    MERGE = "merge"
+
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, MERGE)
+
+    def __init__(self, name: str, maxsize: int = 0, policy: str = BLOCK, on_drop=None, merge_max: int = 0):
+        super().__init__(maxsize=maxsize)
+        if policy not in self.POLICIES:
+            raise Exception(f"queue {name}: unknown policy {policy}, expected one of {self.POLICIES}")
+        self.name = name
+        self.policy = policy
+        # on_drop(queue name, reason) for every task dropped or merged away
+        self.on_drop = on_drop
+        self.merge_max = merge_max
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        if item is not None and (self.maxsize <= 0 or self.policy == self.BLOCK):
+            super().put(item, block, timeout)
+            return
+        with self.not_full:
+            if item is not None and self._qsize() >= self.maxsize and not self.overflow(item):
+                return
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def overflow(self, item) -> bool:
+        """ make room for item, False if item itself went away """
+        if self.policy == self.MERGE and len(self.queue) > 0 and self.queue[-1] is not None:
+            merged = merge_tasks(self.queue[-1], item, self.merge_max)
+            if merged is not None:
+                self.queue[-1] = merged
+                self.drop("merged")
+                return False
+
+        if self.policy == self.DROP_NEWEST:
+            item.cut_resolve()
+            item.release()
+            self.drop("newest")
+            return False
+
+        for i, queued in enumerate(self.queue):
+            if queued is not None:
+                queued.cut_resolve()
+                queued.release()
+                del self.queue[i]
+                self.unfinished_tasks -= 1
+                self.drop("oldest")
+                break
+        return True
+
+    def drop(self, reason: str):
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(self.name, reason)
+
 
 class RTaskControl:
-    redis: redis.Redis
-    queue_command = queue.Queue()
-    queue_slice = queue.Queue()
-    queue_transcribe = queue.Queue()
-    queue_translate = queue.Queue()
-    queue_manifest = queue.Queue()
+    redis: 'redis.Redis' = None
 
     def __init__(
             self,
             cfg: dict,
-            gui_root: RGuiRoot,
+            gui_root: 'RGuiRoot' = None,
             thread_pool_size: int = 0,
     ):
         self.cfg = cfg
@@ -190,11 +433,73 @@ class RTaskControl:
         if thread_pool_size <= 0:
             thread_pool_size = multiprocessing.cpu_count()
         self.thread_pool = ThreadPoolExecutor(max_workers=thread_pool_size)
+        # objects shared by all the workers of a stage (caches...), see shared()
+        self.shares = {}
+        # reentrant: a factory may take another shared object (the breaker its latency window)
+        self.shares_lock = threading.RLock()
+        # latency histograms, counters... of all the stages, exposed by MetricsCtrl
+        self.metrics = Registry()
+
+        # model input of the slices, handed on by reference, see AudioArena
+        self.arena: AudioArena = None
+        self.arena_of()
+
+        self.queue_command = queue.Queue()
+        self.queue_denoise = self.queue_of("denoise")
+        self.queue_slice = self.queue_of("slice")
+        self.queue_transcribe = self.queue_of("transcribe")
+        self.queue_translate = self.queue_of("translate")
+        self.queue_manifest = self.queue_of("manifest")
+        # where the recorder puts the captured blocks: through the denoiser, or straight to the slicer
+        self.queue_capture = self.queue_denoise if sim.getv(cfg, False, "denoiser", "active") else self.queue_slice
+
+    def queue_of(self, name: str) -> RQueue:
+        cfg_queue = self.cfg.get("queues", {}).get(name, None) or {}
+        return RQueue(
+            name=name,
+            maxsize=cfg_queue.get("size", 0),
+            policy=cfg_queue.get("policy", RQueue.BLOCK),
+            on_drop=self.queue_dropped,
+            merge_max=self.merge_max_of(),
+        )
+
+    def merge_max_of(self) -> int:
+        """ samples a merged slice may reach: the slicer's forced cut length, the 30s whisper window without one """
+        max_len = sim.getv(self.cfg, 0, "slicer", "max_len")
+        if max_len <= 0:
+            return 30 * audioutil.MODEL_SAMPLE_RATE
+        frame_duration = sim.getv(self.cfg, 10, "recorder", "frame_duration")
+        return max_len * frame_duration * audioutil.MODEL_SAMPLE_RATE // 1000
+
+    def arena_of(self) -> AudioArena:
+        cfg_arena = self.cfg.get("arena", {}) or {}
+        if not cfg_arena.get("active", False):
+            return None
+        seconds = cfg_arena.get("seconds", 120)
+        # the process backend attaches to it
+        shared = cfg_arena.get("shared", True)
+        self.arena = AudioArena(capacity=int(seconds * audioutil.MODEL_SAMPLE_RATE), shared=shared)
+        return self.arena
+
+    def queue_dropped(self, name: str, reason: str):
+        self.metrics.counter("queue_dropped_total", "Tasks dropped or merged away by full queues", ("queue", "reason")) \
+            .inc(queue=name, reason=reason)
+
+    def shared(self, key: str, factory):
+        """ get the object shared under key, created by factory() on first use """
+        with self.shares_lock:
+            ret = self.shares.get(key, None)
+            if ret is None:
+                ret = self.shares[key] = factory()
+            return ret
 
     def terminate(self):
-        self.queue_command.put("exit")
+        self.queue_command.put(RCommand("exit"))
+        self.queue_denoise.put(None)
         self.queue_slice.put(None)
         self.queue_transcribe.put(None)
         self.queue_translate.put(None)
         self.queue_manifest.put(None)
         self.thread_pool.shutdown()
+        if self.arena is not None:
+            self.arena.unlink()
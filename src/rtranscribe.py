@@ -1,17 +1,49 @@
+import contextlib
 import io
 import logging
+import queue
 import threading
+import time
 import traceback
 import typing
 
-from faster_whisper import WhisperModel
+import numpy
 
 from src import rtask
-from src.common import sim
+from src.common import audioutil, importutil, metrics, sim
 
+if typing.TYPE_CHECKING:
+    from faster_whisper.tokenizer import Tokenizer
+    from src.rpool import RModelPool
 
 # import cutlet
 
+
+def segments_of(model, audio, beam_size: int, prompt: str, echo: str):
+    """ the segments of model.transcribe, without the empty ones and the ones repeating `echo` (the prompt) """
+    segments, info = model.transcribe(
+        audio=audio,
+        # the pathes explored by the beam search
+        beam_size=beam_size,
+        # language
+        # language=self.lang_src,
+        #
+        initial_prompt=prompt,
+        #
+        vad_filter=True
+    )
+
+    def texts():
+        for segment in segments:
+            t = segment.text
+            if echo in t.strip():
+                continue
+            if t.strip().replace('.', ''):
+                yield segment
+
+    return texts(), info
+
+
 class RTranscriber(threading.Thread):
     lang_src: str
     beam_size: int
@@ -21,6 +53,12 @@ class RTranscriber(threading.Thread):
     device: str
     compute_type: str
     prompt: str
+    batch_active: bool
+    batch_size: int
+    batch_window: int
+    stream_agreement: int
+    deadline_action: str
+    overlap_wait: float
 
     def __init__(
             self,
@@ -34,6 +72,8 @@ class RTranscriber(threading.Thread):
 
         self.do_run = True
         self.model = None
+        # the listener's model replicas, see lease()
+        self.pool: 'RModelPool' = None
 
         self.logger = logging.getLogger(f'transcriber-{self.index}')
         self.configure()
@@ -57,13 +97,21 @@ class RTranscriber(threading.Thread):
         self.device = sim.getv(cfg, "cuda", "device")
         self.compute_type = sim.getv(cfg, "default", "compute_type")
         self.prompt = sim.getv(cfg, "transcriber here", "prompt")
+        # batching trades latency for throughput: wait up to batch_window ms for batch_size slices
+        self.batch_active = sim.getv(cfg, False, "batch", "active")
+        self.batch_size = sim.getv(cfg, 4, "batch", "size")
+        self.batch_window = sim.getv(cfg, 50, "batch", "window")
+        self.stream_agreement = max(1, sim.getv(cfg, 2, "stream", "agreement"))
+        self.deadline_action = sim.getv(self.task_ctrl.cfg, "degrade", "deadline", "transcribe")
+        self.overlap_wait = sim.getv(cfg, 10, "overlap_wait")
         return self
 
     def init(self, force: bool = False) -> 'RTranscriber':
         if self.model is not None and force is False:
             return self
         # local_file_only = True if len(self.download_root) > 0 else False
-        self.model = WhisperModel(
+        faster_whisper = importutil.load("faster_whisper")
+        self.model = faster_whisper.WhisperModel(
             model_size_or_path=self.model_size,
             device=self.device,
             compute_type=self.compute_type,
@@ -72,26 +120,64 @@ class RTranscriber(threading.Thread):
         )
         return self
 
+    @contextlib.contextmanager
+    def lease(self):
+        """ a replica of the pool for one pass, it becomes self.model; without a pool self.model is used as is """
+        if self.pool is None:
+            yield self.model
+            return
+        with self.pool.lease() as replica:
+            self.model = replica.model
+            yield self.model
+
     def __enter__(self) -> 'RTranscriber':
         return self.init()
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         pass
 
-    def process(self, task: rtask.RTask) -> typing.Generator[str, None, None]:
+    @staticmethod
+    def audio_of(task: rtask.RTask):
+        if task.samples is not None:
+            return task.samples
+        if task.audio is not None:
+            return io.BytesIO(task.audio)
+        return None
+
+    def deadline_of(self, task: rtask.RTask) -> str:
+        """ "" for a fresh task, else what to do with the stale one: degrade or drop.
+        a stale partial is always dropped, the final pass of its utterance follows
+        """
+        if not task.info.expired():
+            return ""
+        action = "drop" if task.partial else self.deadline_action
+        self.task_ctrl.metrics.counter("deadline_expired_total", "Stale tasks by stage and action", ("stage", "action")) \
+            .inc(stage="transcribe", action=action)
+        return action
 
-        data = task.audio
+    def process(self, task: rtask.RTask, beam_size: int = 0) -> typing.Generator[str, None, None]:
 
-        segments, info = self.model.transcribe(
-            audio=io.BytesIO(data),
-            # the pathes explored by the beam search
-            beam_size=self.beam_size,
-            # language
-            # language=self.lang_src,
-            #
-            initial_prompt=self.prompt,
-            #
-            vad_filter=True
+        audio = self.audio_of(task)
+        prompt = self.prompt
+
+        # streaming: the committed words were decoded by the partial passes already
+        state = task.stream
+        if state is not None and task.samples is not None:
+            with state.lock:
+                state.final = True
+                committed = state.committed
+                offset = state.offset
+            audio = task.samples[int(offset * audioutil.MODEL_SAMPLE_RATE):]
+            if len(committed) > 0:
+                prompt = committed
+                yield committed
+
+        segments, info = segments_of(
+            model=self.model,
+            audio=audio,
+            beam_size=beam_size if beam_size > 0 else self.beam_size,
+            prompt=prompt,
+            echo=self.prompt,
         )
 
         task.text_info = info
@@ -99,14 +185,168 @@ class RTranscriber(threading.Thread):
         # if info.language != "zh":
         #     return {"error": "transcribe Chinese only"}
         for segment in segments:
-            t = segment.text
             task.text_start = segment.start
             task.text_end = segment.end
+            yield segment.text
+        pass
+
+    def stream_agree(self, state: rtask.RStream, words: list):
+        """ local agreement: commit the word prefix shared by the last stream_agreement passes """
+        state.history.append([w.word.strip().lower() for w in words])
+        state.history = state.history[-self.stream_agreement:]
+        if len(state.history) < self.stream_agreement:
+            return
+        stable = 0
+        for units in zip(*state.history):
+            if any(unit != units[0] for unit in units):
+                break
+            stable += 1
+        if stable <= 0:
+            return
+        state.committed += "".join(w.word for w in words[:stable])
+        state.offset += words[stable - 1].end
+        # word positions were relative to the old offset
+        state.history.clear()
+
+    def process_partial(self, task: rtask.RTask):
+        state = task.stream
+        # a pass over this utterance is running already, a newer partial will follow
+        if not state.lock.acquire(blocking=False):
+            return
+        try:
+            if state.final:
+                return
+            audio = task.samples[int(state.offset * audioutil.MODEL_SAMPLE_RATE):]
+            segments, info = self.model.transcribe(
+                audio=audio,
+                beam_size=self.beam_size,
+                initial_prompt=state.committed if len(state.committed) > 0 else self.prompt,
+                word_timestamps=True,
+                condition_on_previous_text=False,
+            )
+            words = []
+            for segment in segments:
+                if segment.words is not None:
+                    words.extend(segment.words)
+            hypothesis = "".join(w.word for w in words)
+            # the hypothesis covers the audio after the offset, the committed text the audio before
+            text = (state.committed + hypothesis).strip()
+            self.stream_agree(state, words)
+        finally:
+            state.lock.release()
+
+        if len(text) <= 0:
+            return
+        task.text_transcribe = text
+        task.text_info = info
+        task.info.time_set("transcribe_end")
+        # partial hypotheses go straight to display, only the final task is translated
+        self.task_ctrl.queue_manifest.put(task)
+
+    def batch_collect(self) -> typing.List[rtask.RTask]:
+        task: rtask.RTask = self.task_ctrl.queue_transcribe.get()
+        if task is None:
+            # keep the terminate signal for the other transcribers
+            self.task_ctrl.queue_transcribe.put(None)
+            return []
+        tasks = [task]
+        deadline = time.monotonic() + self.batch_window / 1000
+        while len(tasks) < self.batch_size:
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                break
+            try:
+                task = self.task_ctrl.queue_transcribe.get(timeout=remain)
+            except queue.Empty:
+                break
+            if task is None:
+                # keep the terminate signal for the other transcribers
+                self.task_ctrl.queue_transcribe.put(None)
+                break
+            tasks.append(task)
+        return tasks
+
+    def batch_prompt(self, tokenizer: 'Tokenizer') -> typing.List[int]:
+        prompt = [tokenizer.sot_prev]
+        if self.prompt is not None and len(self.prompt) > 0:
+            tokens = tokenizer.encode(" " + self.prompt.strip())
+            prompt.extend(tokens[-(self.model.max_length // 2 - 1):])
+        prompt.extend(tokenizer.sot_sequence)
+        prompt.append(tokenizer.no_timestamps)
+        return prompt
+
+    def process_batch(self, tasks: typing.List[rtask.RTask], beam_size: int = 0) -> typing.List[str]:
+        """ one encoder pass + one decoder pass for all the slices of the batch,
+        slices longer than the 30s whisper window go through the sequential path
+        """
+        texts = [""] * len(tasks)
+
+        extractor = self.model.feature_extractor
+        vad = importutil.load("faster_whisper.vad")
+        batch_index = []
+        batch_features = []
+        for i, task in enumerate(tasks):
+            audio = task.samples
+            if audio is None:
+                audio = importutil.load("faster_whisper.audio").decode_audio(
+                    io.BytesIO(task.audio), sampling_rate=extractor.sampling_rate)
+            duration = len(audio) / extractor.sampling_rate
+            if len(audio) > extractor.n_samples or task.stream is not None:
+                texts[i] = "".join(self.process(task, beam_size))
+                continue
+            # the speech only, as model.transcribe(vad_filter=True) on the sequential path
+            audio = vad.collect_chunks(audio, vad.get_speech_timestamps(audio))
+            if len(audio) <= 0:
+                task.text_info = rtask.RTextInfo(duration=duration)
+                continue
+            features = extractor(audio)[:, :extractor.nb_max_frames]
+            if features.shape[-1] < extractor.nb_max_frames:
+                pad = extractor.nb_max_frames - features.shape[-1]
+                features = numpy.pad(features, ((0, 0), (0, pad)))
+            task.text_info = rtask.RTextInfo(duration=duration)
+            batch_index.append(i)
+            batch_features.append(features)
+
+        if len(batch_features) <= 0:
+            return texts
+
+        features = numpy.ascontiguousarray(numpy.stack(batch_features), dtype=numpy.float32)
+        ctranslate2 = importutil.load("ctranslate2")
+        encoder_output = self.model.model.encode(ctranslate2.StorageView.from_array(features))
+
+        prompts = []
+        tokenizers = []
+        languages = self.model.model.detect_language(encoder_output)
+        for i, language in zip(batch_index, languages):
+            token, probability = language[0]
+            info = tasks[i].text_info
+            info.language = token[2:-2]
+            info.language_probability = probability
+            tokenizer = importutil.load("faster_whisper.tokenizer").Tokenizer(
+                self.model.hf_tokenizer,
+                self.model.model.is_multilingual,
+                task="transcribe",
+                language=info.language,
+            )
+            tokenizers.append(tokenizer)
+            prompts.append(self.batch_prompt(tokenizer))
+
+        results = self.model.model.generate(
+            encoder_output,
+            prompts,
+            beam_size=beam_size if beam_size > 0 else self.beam_size,
+            max_length=self.model.max_length,
+            suppress_blank=True,
+            suppress_tokens=[-1],
+        )
+
+        for i, tokenizer, result in zip(batch_index, tokenizers, results):
+            t = tokenizer.decode(result.sequences_ids[0])
             if self.prompt in t.strip():
                 continue
             if t.strip().replace('.', ''):
-                yield t
-        pass
+                texts[i] = t
+        return texts
 
     ignore_list_single = [
         "♪"
@@ -127,33 +367,132 @@ class RTranscriber(threading.Thread):
                 return True
         return False
 
+    def deliver(self, task: rtask.RTask, text: str):
+        # a forced cut repeats the end of the previous slice, which another transcriber may still be decoding:
+        # wait for its text, then drop the words transcribed twice
+        cut = task.cut_head
+        task.cut_head = None
+        if cut is not None:
+            if not cut.done.wait(self.overlap_wait):
+                self.logger.warning(f"previous slice not transcribed after {self.overlap_wait}s, overlap kept")
+            if len(cut.text) > 0:
+                text = sim.Text.dedupe_overlap(cut.text, text)
+
+        text = text.strip()
+        task.cut_resolve(text)
+        if len(text) <= 0:
+            return
+
+        if self.ignore(text):
+            self.logger.info("ignore text: %s" % text)
+            return
+
+        task.text_transcribe = text
+        task.info.time_set("transcribe_end")
+        self.rtf_observe(task)
+        self.task_ctrl.queue_translate.put(task)
+
+    def rtf_observe(self, task: rtask.RTask):
+        """ real-time factor: transcription time / audio duration, under 1 keeps up with the audio """
+        elapsed = task.info.time_diff("transcribe_start", "transcribe_end")
+        duration = task.text_info.duration if task.text_info is not None else 0
+        if elapsed is None or duration is None or duration <= 0:
+            return
+        self.task_ctrl.metrics.histogram(
+            "transcribe_rtf", "Real-time factor of the transcriptions", buckets=metrics.RATIO_BUCKETS,
+        ).observe(elapsed / 1000 / duration)
+
+    def run_batch(self):
+        self.logger.info(f"batch mode | size: {self.batch_size} | window: {self.batch_window}ms")
+        error_count = 0
+        while self.do_run:
+            collected = []
+            try:
+                collected = self.batch_collect()
+                if len(collected) <= 0:
+                    break
+                tasks = [task for task in collected if self.audio_of(task) is not None]
+                fresh = []
+                stale = []
+                for task in tasks:
+                    task.info.time_set("transcribe_start")
+                    action = self.deadline_of(task)
+                    if action == "drop":
+                        continue
+                    if task.partial:
+                        with self.lease():
+                            self.process_partial(task)
+                    elif action == "degrade":
+                        stale.append(task)
+                    else:
+                        fresh.append(task)
+                # stale slices are decoded greedily, to catch up with the audio
+                texts = {}
+                for group, beam_size in ((fresh, self.beam_size), (stale, 1)):
+                    if len(group) <= 0:
+                        continue
+                    with self.lease():
+                        texts.update(zip(map(id, group), self.process_batch(group, beam_size)))
+                # in queue order: the slice after a forced cut waits for the one before it, see deliver
+                for task in tasks:
+                    if id(task) in texts:
+                        self.deliver(task, texts[id(task)])
+            except Exception:
+                traceback.print_exc()
+                if error_count > 3:
+                    self.logger.warning("error_count > 3, breaking...")
+                    break
+                error_count += 1
+            finally:
+                for task in collected:
+                    task.cut_resolve()
+                    task.release()
+
+    def handle(self, task: rtask.RTask):
+        if self.audio_of(task) is None:
+            return
+        task.info.time_set("transcribe_start")
+        action = self.deadline_of(task)
+        if action == "drop":
+            return
+
+        if task.partial:
+            with self.lease():
+                self.process_partial(task)
+            return
+
+        # stale slices are decoded greedily, to catch up with the audio
+        beam_size = 1 if action == "degrade" else self.beam_size
+
+        # text = codefast.fp.cyan('')
+        text = ''
+        with self.lease():
+            for seg in self.process(task, beam_size):
+                text += seg
+                # text += codefast.fp.cyan(seg)
+
+        self.deliver(task, text)
+
     def run(self):
         self.logger.info(f"running | source language: {self.lang_src} | model: {self.model_size}")
+        if self.batch_active:
+            self.run_batch()
+            self.logger.info("[transcriber] end")
+            return
         error_count = 0
         while self.do_run:
             try:
                 task: rtask.RTask = self.task_ctrl.queue_transcribe.get()
-                if task.audio is None:
-                    continue
-
-                # text = codefast.fp.cyan('')
-                text = ''
-                for seg in self.process(task):
-                    text += seg
-                    # text += codefast.fp.cyan(seg)
-
-                text = text.strip()
-                if len(text) <= 0:
-                    continue
-
-                if self.ignore(text):
-                    self.logger.info("ignore text: %s" % text)
-                    continue
-
-                task.text_transcribe = text
-                task.info.time_set("transcribe")
-                task.info.time_diff("slice", "transcribe", store="transcribe")
-                self.task_ctrl.queue_translate.put(task)
+                if task is None:
+                    # keep the terminate signal for the other transcribers
+                    self.task_ctrl.queue_transcribe.put(None)
+                    break
+                try:
+                    self.handle(task)
+                finally:
+                    # decoded or dropped, the samples' arena block goes back
+                    task.cut_resolve()
+                    task.release()
             except Exception:
                 traceback.print_exc()
                 if error_count > 3:
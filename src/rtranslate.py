@@ -1,14 +1,59 @@
 import asyncio
+import heapq
 import logging
 import threading
+import time
 import traceback
-
-import cutlet
+import typing
+from concurrent.futures import ThreadPoolExecutor
 
 from src import rtask
-from src.common import sim
-from src.service import poe_ctrl, ollama_ctrl
-from src.service.google import google_trans
+from src.common import importutil, sim
+from src.common.breaker import CircuitBreaker
+from src.common.cache import LruCache
+from src.common.stats import LatencyWindow
+from src.service import stub_ctrl
+
+if typing.TYPE_CHECKING:
+    import cutlet
+    from src.service import poe_ctrl, ollama_ctrl
+    from src.service.google import google_trans
+
+
+def cutlet_of() -> 'cutlet.Cutlet':
+    """ loading the dictionary takes seconds, one instance per translator, see RTaskControl.shared """
+    return importutil.load("cutlet").Cutlet()
+
+
+class RSequencer:
+    """ Releases concurrently translated tasks in task.info.sequence order.
+
+    Tasks are admitted when pulled from the queue, a finished task waits until
+    every admitted task with a smaller sequence is finished too.
+    Only used from the translator's event loop, so no locking.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.admitted = 0
+
+    def admit(self, task: rtask.RTask) -> list:
+        # [sequence, admission order, task, done, forward]
+        entry = [task.info.sequence, self.admitted, task, False, False]
+        self.admitted += 1
+        heapq.heappush(self.pending, entry)
+        return entry
+
+    def done(self, entry: list, forward: bool) -> list:
+        """ mark entry finished, returns the tasks now ready to go on, in order """
+        entry[3] = True
+        entry[4] = forward
+        ready = []
+        while len(self.pending) > 0 and self.pending[0][3]:
+            head = heapq.heappop(self.pending)
+            if head[4]:
+                ready.append(head[2])
+        return ready
 
 
 class RTranslator(threading.Thread):
@@ -24,15 +69,32 @@ class RTranslator(threading.Thread):
         self.task_ctrl = task_ctrl
         self.index = index
         self.do_run = True
+        # set once the agents are warmed up, the listener holds the recorder until then
+        self.ready = threading.Event()
 
-        self.agent_poe: poe_ctrl.PoeCtrl = None
-        self.agent_ollama: ollama_ctrl.OllamaCtrl = None
-        self.agent_google: google_trans.GoogleTransCtrl = None
+        self.agent_poe: 'poe_ctrl.PoeCtrl' = None
+        self.agent_ollama: 'ollama_ctrl.OllamaCtrl' = None
+        self.agent_google: 'google_trans.GoogleTransCtrl' = None
+        self.agent_stub: stub_ctrl.StubCtrl = None
 
-        self.phoneme_ja: cutlet.Cutlet = None
+        self.phoneme_ja: 'cutlet.Cutlet' = None
 
         self.lang_des = "en"
 
+        # translations in flight on this translator's event loop
+        self.concurrency = 4
+        # chain: agents one after another on failure, race: hedge the late ones with the next agent
+        self.policy = "chain"
+        self.hedge = {}
+        # per agent circuit breaker settings, the breakers are shared by all translators
+        self.breaker = {}
+        # blocking agents and the queue bridge run there, off the event loop
+        self.executor: ThreadPoolExecutor = None
+        self.sequencer = RSequencer()
+        self.error_count = 0
+        # stale tasks: degrade (shown untranslated) or drop
+        self.deadline_action = "degrade"
+
         self.phoneme = {
             "convert": False,
             "translate": False,
@@ -43,6 +105,10 @@ class RTranslator(threading.Thread):
             "persist": 0,
         }
 
+        # in-process cache in front of redis, shared by all translators
+        self.cache_memory: LruCache = None
+        self.cache_memory_len = 0
+
         self.logger = logging.getLogger(f'translator-{self.index}')
         self.configure()
         pass
@@ -52,13 +118,20 @@ class RTranslator(threading.Thread):
 
         trans_cfg = self.task_ctrl.cfg.get("translator", {})
         self.lang_des = trans_cfg.get('lang_des', 'en')
+        self.concurrency = max(1, trans_cfg.get('concurrency', 4))
+        self.policy = trans_cfg.get('policy', 'chain').lower()
+        self.hedge = trans_cfg.get('hedge', None) or {}
+        self.breaker = trans_cfg.get('breaker', None) or {}
+        self.deadline_action = sim.getv(cfg, "degrade", "deadline", "translate")
 
         self.configure_poe(cfg)
         self.configure_ollama(cfg)
         self.configure_google(cfg)
+        self.configure_stub(cfg)
 
         self.configure_phoneme(cfg)
         self.configure_cache_redis(cfg)
+        self.configure_cache_memory(cfg)
         pass
 
     def configure_phoneme(self, cfg):
@@ -70,7 +143,8 @@ class RTranslator(threading.Thread):
             "only": sim.getv(phoneme_cfg, False, "only"),
         }
         if convert:
-            self.phoneme_ja = cutlet.Cutlet()
+            # the startup may have loaded it already, see RListener.startup
+            self.phoneme_ja = self.task_ctrl.shared(f"cutlet-{self.index}", cutlet_of)
         pass
 
     def configure_cache_redis(self, cfg):
@@ -88,17 +162,40 @@ class RTranslator(threading.Thread):
         }
         pass
 
+    def configure_cache_memory(self, cfg):
+        cache_memory_cfg = sim.getv(cfg, {}, "translator", "cache_memory")
+        size = sim.getv(cache_memory_cfg, 0, "size")
+        if size <= 0:
+            return
+        ttl = sim.getv(cache_memory_cfg, 0, "ttl")
+        self.cache_memory_len = sim.getv(cache_memory_cfg, 32, "max_len")
+        self.cache_memory = self.task_ctrl.shared(
+            "cache_translate",
+            lambda: LruCache(size=size, ttl=ttl),
+        )
+
     def configure_google(self, cfg):
         active = sim.getv(cfg, False, "translator", "agent_google", "active")
         if not active:
             return
-        self.agent_google = google_trans.GoogleTransCtrl(self.task_ctrl.cfg)
-        self.agent_google.configure()
+        # one ctrl, and so one connection pool, for all the translators
+        google_trans = importutil.load("src.service.google.google_trans")
+        self.agent_google = self.task_ctrl.shared(
+            "agent_google",
+            lambda: google_trans.GoogleTransCtrl(self.task_ctrl.cfg).configure(),
+        )
+
+    def configure_stub(self, cfg):
+        active = sim.getv(cfg, False, "translator", "agent_stub", "active")
+        if not active:
+            return
+        self.agent_stub = stub_ctrl.StubCtrl(self.task_ctrl.cfg).configure()
 
     def configure_poe(self, cfg):
         active = sim.getv(cfg, False, "translator", "agent_poe", "active")
         if not active:
             return
+        poe_ctrl = importutil.load("src.service.poe_ctrl")
         self.agent_poe = poe_ctrl.PoeCtrl(self.task_ctrl.cfg)
         self.agent_poe.configure("translate")
 
@@ -106,6 +203,7 @@ class RTranslator(threading.Thread):
         active = sim.getv(cfg, False, "translator", "agent_ollama", "active")
         if not active:
             return
+        ollama_ctrl = importutil.load("src.service.ollama_ctrl")
         self.agent_ollama = ollama_ctrl.OllamaCtrl(self.task_ctrl.cfg)
         self.agent_ollama.configure("translate")
 
@@ -130,34 +228,136 @@ class RTranslator(threading.Thread):
 
         return task.text_phoneme
 
+    def agents_of(self, text, lang_src) -> list:
+        """ (name, coroutine factory) of the active agents, in priority order """
+        agents = []
+        if self.agent_stub is not None:
+            agents.append(("stub", lambda: self.agent_stub.translate(text, lang_src, self.lang_des)))
+        if self.agent_ollama is not None:
+            agents.append(("ollama", lambda: self.agent_ollama.translate(text, lang_src, self.lang_des)))
+        if self.agent_poe is not None:
+            loop = asyncio.get_running_loop()
+            agents.append(("poe", lambda: loop.run_in_executor(
+                self.executor, self.agent_poe.translate, text, lang_src, self.lang_des)))
+        if self.agent_google is not None:
+            agents.append(("google", lambda: self.agent_google.translate_async(text, lang_src, self.lang_des)))
+        return agents
+
+    def latency_of(self, name: str) -> LatencyWindow:
+        return self.task_ctrl.shared(
+            f"latency_{name}",
+            lambda: LatencyWindow(size=self.hedge.get("window", 100)),
+        )
+
+    def hedge_delay(self, name: str) -> float:
+        """ seconds to wait on an agent before racing the next one, its observed latency quantile once known """
+        delay = self.hedge.get("delay", 800)
+        latency = self.latency_of(name)
+        if len(latency) >= self.hedge.get("samples", 10):
+            delay = latency.quantile(self.hedge.get("quantile", 0.95), delay)
+        delay = min(max(delay, self.hedge.get("min", 100)), self.hedge.get("max", 3000))
+        return delay / 1000
+
+    def breaker_of(self, name: str) -> CircuitBreaker:
+        cfg = self.breaker
+        return self.task_ctrl.shared(
+            f"breaker_{name}",
+            lambda: CircuitBreaker(
+                name=name,
+                latency=self.latency_of(name),
+                window=cfg.get("window", 30),
+                min_calls=cfg.get("min_calls", 5),
+                error_rate=cfg.get("error_rate", 0.5),
+                open_time=cfg.get("open_time", 30),
+                timeout=cfg.get("timeout", None),
+            ),
+        )
+
+    async def call_agent(self, name: str, factory) -> str:
+        breaker = self.breaker_of(name)
+        calls = self.task_ctrl.metrics.counter("translate_agent_calls_total", "Agent calls by outcome", ("agent", "outcome"))
+        # the backend is known to be down, skip it without waiting
+        if not breaker.allow():
+            calls.inc(agent=name, outcome="rejected")
+            return ""
+        start = time.monotonic()
+        try:
+            ret = self.result_adapt(await asyncio.wait_for(factory(), breaker.timeout()))
+        except asyncio.CancelledError:
+            breaker.cancel()
+            calls.inc(agent=name, outcome="cancelled")
+            raise
+        except Exception as ex:
+            calls.inc(agent=name, outcome="timeout" if isinstance(ex, asyncio.TimeoutError) else "error")
+            if breaker.failure():
+                self.logger.error(f"{name} failed, circuit opened: {ex}", exc_info=True, stack_info=True)
+            else:
+                self.logger.warning(f"{name} failed: {type(ex).__name__} {ex}")
+            return ""
+        if ret is None or len(ret) <= 0:
+            breaker.failure()
+            calls.inc(agent=name, outcome="empty")
+            return ""
+        latency = (time.monotonic() - start) * 1000
+        breaker.success(latency)
+        calls.inc(agent=name, outcome="ok")
+        self.task_ctrl.metrics.histogram("translate_agent_latency_ms", "Latency of the agents' answers", ("agent",)) \
+            .observe(latency, agent=name)
+        return ret
+
+    async def translate_chain(self, agents) -> str:
+        for name, factory in agents:
+            ret = await self.call_agent(name, factory)
+            if len(ret) > 0:
+                return ret
+        return ""
+
+    async def translate_race(self, agents) -> str:
+        """ start the first agent, race the next one whenever the current one is late or failed,
+        take the first answer and cancel the rest """
+        if len(agents) <= 0:
+            return ""
+        waiting = list(agents)
+        running = {}
+
+        def launch():
+            name, factory = waiting.pop(0)
+            running[asyncio.ensure_future(self.call_agent(name, factory))] = name
+            return name
+
+        current = launch()
+        try:
+            while len(running) > 0:
+                timeout = self.hedge_delay(current) if len(waiting) > 0 else None
+                done, _ = await asyncio.wait(running.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for job in done:
+                    name = running.pop(job)
+                    ret = job.result()
+                    if len(ret) > 0:
+                        if len(agents) - len(waiting) > 1:
+                            self.logger.debug(f"race won by {name}")
+                        return ret
+                if len(waiting) > 0:
+                    current = launch()
+            return ""
+        finally:
+            for job in running.keys():
+                job.cancel()
+
     async def translate(self, task, text, lang_src):
         if lang_src == self.lang_des:
             return text
 
-        ret = ""
-
         if len(task.text_phoneme) > 0 and self.phoneme.get("translate", False):
             if self.phoneme.get("only", False):
                 text = task.text_phoneme
             else:
                 text = text + " | " + task.text_phoneme
 
-        if len(ret) <= 0 and self.agent_ollama is not None:
-            try:
-                ret = await self.agent_ollama.translate(text, lang_src, self.lang_des)
-            except Exception as ex:
-                self.logger.error(ex, exc_info=True, stack_info=True)
-
-        if len(ret) <= 0 and self.agent_poe is not None:
-            try:
-                ret = self.agent_poe.translate(text, lang_src, self.lang_des)
-            except Exception as ex:
-                self.logger.error(ex, exc_info=True, stack_info=True)
-
-        if len(ret) <= 0 and self.agent_google is not None:
-            ret = self.agent_google.translate(text, lang_src, self.lang_des)
-
-        return ret
+        agents = self.agents_of(text, lang_src)
+        if self.policy == "race":
+            return await self.translate_race(agents)
+        return await self.translate_chain(agents)
 
     async def warmup(self):
         try:
@@ -168,7 +368,8 @@ class RTranslator(threading.Thread):
 
         try:
             if self.agent_poe is not None and self.agent_poe.active:
-                self.agent_poe.warmup("translate")
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, self.agent_poe.warmup, "translate")
         except Exception as ex:
             self.logger.error(ex, exc_info=True, stack_info=True)
 
@@ -182,22 +383,38 @@ class RTranslator(threading.Thread):
             result = result.strip()
         return result
 
+    @staticmethod
+    def cache_key(task, lang_des):
+        text = " ".join(task.text_transcribe.split()).lower()
+        return task.text_info.language, lang_des, text
+
     def cache_fetch(self, task):
         translated = ""
         transcribe_len = len(task.text_transcribe)
         redis_fetch = self.cache_redis.get("fetch", 0)
         lang_key = f"{task.text_info.language}_{self.lang_des}"
 
+        memory_key = None
+        if self.cache_memory is not None and transcribe_len <= self.cache_memory_len:
+            memory_key = self.cache_key(task, self.lang_des)
+            translated = self.cache_memory.get(memory_key, "")
+            if len(translated) > 0:
+                return translated, True
+
         if redis_fetch > 0 and transcribe_len <= redis_fetch:
             redis_ret = self.task_ctrl.redis.hmget(lang_key, task.text_transcribe)
             if redis_ret is not None and len(redis_ret) > 0:
                 byte_data = redis_ret[0]
                 if byte_data is not None and len(byte_data) > 0:
                     translated = byte_data.decode("utf-8")
+            self.task_ctrl.metrics.counter("cache_redis_total", "Redis translation cache lookups", ("result",)) \
+                .inc(result="hit" if len(translated) > 0 else "miss")
 
         cached = translated is not None and len(translated) > 0
         if cached:
             self.logger.info(f"cache_fetch {lang_key} | {task.text_transcribe} -> {translated}")
+            if memory_key is not None:
+                self.cache_memory.put(memory_key, translated)
 
         return translated, cached
 
@@ -215,6 +432,9 @@ class RTranslator(threading.Thread):
 
         transcribe_len = len(task.text_transcribe)
 
+        if self.cache_memory is not None and transcribe_len <= self.cache_memory_len:
+            self.cache_memory.put(self.cache_key(task, self.lang_des), translated)
+
         redis_persist = self.cache_redis.get("persist", 0)
 
         if redis_persist > 0 and transcribe_len <= redis_persist:
@@ -231,60 +451,114 @@ class RTranslator(threading.Thread):
 
         pass
 
+    async def handle(self, task: rtask.RTask) -> bool:
+        """ translate one task, True if it goes on to the manifest """
+        if task.text_transcribe is None or len(task.text_transcribe) <= 0:
+            return False
+
+        task.info.time_set("translate_start")
+        task.param.lang_des = self.lang_des
+
+        if task.info.expired():
+            self.task_ctrl.metrics.counter("deadline_expired_total", "Stale tasks by stage and action", ("stage", "action")) \
+                .inc(stage="translate", action=self.deadline_action)
+            if self.deadline_action == "drop":
+                return False
+            # shown untranslated rather than late
+            task.text_translate = ""
+            task.info.time_set("translate_end")
+            task.param.lang_src = task.text_info.language
+            return True
+
+        translated = None
+        cached = False
+        if task.text_info.language == self.lang_des:
+            translated = task.text_transcribe
+            cached = True
+
+        self.phoneme_handle(task)
+
+        if not cached:
+            if self.cache_redis.get("fetch", 0) > 0:
+                loop = asyncio.get_running_loop()
+                translated, cached = await loop.run_in_executor(self.executor, self.cache_fetch, task)
+            else:
+                translated, cached = self.cache_fetch(task)
+
+        if not cached:
+            translated = await self.translate(
+                task,
+                task.text_transcribe,
+                task.text_info.language,
+            )
+
+        translated = self.result_adapt(translated)
+        if translated is None:
+            return False
+
+        if not cached:
+            self.cache_persist(translated, task)
+
+        task.text_translate = translated
+        task.info.time_set("translate_end")
+        task.param.lang_src = task.text_info.language
+        task.param.lang_des = self.lang_des
+        return True
+
+    async def handle_guarded(self, task: rtask.RTask, entry: list, semaphore: asyncio.Semaphore):
+        forward = False
+        try:
+            forward = await self.handle(task)
+        except Exception:
+            traceback.print_exc()
+            self.error_count += 1
+            if self.error_count > 100:
+                self.logger.warning("error_count > 100, stopping...")
+                self.do_run = False
+        finally:
+            semaphore.release()
+            for ready in self.sequencer.done(entry, forward):
+                self.task_ctrl.queue_manifest.put(ready)
+
     async def cycle(self):
-        self.logger.info("running | destined language: %s" % self.lang_des)
-        error_count = 0
+        self.logger.info("running | destined language: %s | concurrency: %d" % (self.lang_des, self.concurrency))
+        self.error_count = 0
+
+        # one extra thread for the queue bridge
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.concurrency + 1,
+            thread_name_prefix=f"translator-{self.index}",
+        )
+        loop = asyncio.get_running_loop()
 
         try:
             await self.warmup()
         except Exception as ex:
             self.logger.error(ex, exc_info=True, stack_info=True)
+        finally:
+            self.ready.set()
 
+        semaphore = asyncio.Semaphore(self.concurrency)
+        running = set()
         while self.do_run:
-            try:
-                task: rtask.RTask = self.task_ctrl.queue_translate.get()
-                if task.text_transcribe is None or len(task.text_transcribe) <= 0:
-                    continue
-
-                task.param.lang_des = self.lang_des
-
-                translated = None
-                cached = False
-                if task.text_info.language == self.lang_des:
-                    translated = task.text_transcribe
-                    cached = True
-
-                self.phoneme_handle(task)
-
-                if not cached:
-                    translated, cached = self.cache_fetch(task)
-
-                if not cached:
-                    translated = await self.translate(
-                        task,
-                        task.text_transcribe,
-                        task.text_info.language,
-                    )
-
-                translated = self.result_adapt(translated)
-                if translated is None:
-                    continue
-
-                if not cached:
-                    self.cache_persist(translated, task)
-
-                task.text_translate = translated
-                task.info.time_set("translate")
-                task.info.time_diff("transcribe", "translate", store="translate")
-                task.param.lang_src = task.text_info.language
-                task.param.lang_des = self.lang_des
-                self.task_ctrl.queue_manifest.put(task)
-            except Exception:
-                traceback.print_exc()
-                if error_count > 100:
-                    self.logger.warning("error_count > 3, breaking...")
-                    break
-                error_count += 1
+            await semaphore.acquire()
+            task: rtask.RTask = await loop.run_in_executor(self.executor, self.task_ctrl.queue_translate.get)
+            if task is None:
+                # keep the terminate signal for the other translators
+                self.task_ctrl.queue_translate.put(None)
+                semaphore.release()
+                break
+            entry = self.sequencer.admit(task)
+            job = asyncio.create_task(self.handle_guarded(task, entry, semaphore))
+            running.add(job)
+            job.add_done_callback(running.discard)
+
+        if len(running) > 0:
+            await asyncio.gather(*running)
+        if self.agent_google is not None:
+            # this loop's httpx client goes with the loop
+            await self.agent_google.aclose()
+        self.executor.shutdown(wait=False)
         self.logger.info("end")
 
     def run(self):
@@ -1,7 +1,7 @@
 import logging
 
 from src.common import sim
-from src.service.google.translator import GoogleTranslator
+from src.service.google.translator import GoogleTranslator, GoogleSessionPool
 
 
 class GoogleTransCtrl:
@@ -9,6 +9,7 @@ class GoogleTransCtrl:
     def __init__(self, cfg):
         self.cfg = cfg
         self.agent = None
+        self.pool = None
         self.active = False
         self.logger = logging.getLogger('google-trans')
 
@@ -19,9 +20,18 @@ class GoogleTransCtrl:
             return self
         domain = sim.getv(google_cfg, "hk", "domain")
         timeout = sim.getv(google_cfg, 5, "timeout")
+        self.pool = GoogleSessionPool(
+            pool_size=sim.getv(google_cfg, 8, "pool_size"),
+            retries=sim.getv(google_cfg, 2, "retries"),
+            backoff=sim.getv(google_cfg, 0.3, "backoff"),
+            timeout=timeout,
+            http2=sim.getv(google_cfg, False, "http2"),
+            proxies=sim.getv(google_cfg, None, "proxies"),
+        )
         self.agent = GoogleTranslator(
             url_suffix=domain,
             timeout=timeout,
+            pool=self.pool,
         )
         return self
 
@@ -29,3 +39,17 @@ class GoogleTransCtrl:
         return self.agent.translate(
             text, lang_des, lang_src
         )
+
+    async def translate_async(self, text, lang_src, lang_des):
+        return await self.agent.translate_async(
+            text, lang_des, lang_src
+        )
+
+    async def aclose(self):
+        """ from each translator's event loop before it is closed """
+        if self.pool is not None:
+            await self.pool.aclose()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
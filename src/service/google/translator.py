@@ -1,14 +1,24 @@
 # coding:utf-8
 # author LuShan
 # version : 1.1.9
+import asyncio
+import functools
 import json
 import logging
 import random
 import re
+import threading
 from urllib.parse import quote
 
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 from src.common.langutil import LANGUAGES
 from src.service.google.constants import DEFAULT_SERVICE_URLS
@@ -63,6 +73,133 @@ class GoogleNewTranslationError(Exception):
         return "{}. Probable cause: {}".format(premise, cause)
 
 
+class GoogleSessionPool:
+    '''
+    Long-lived keep-alive connections shared by every translator thread.
+
+    requests.Session is not documented as thread-safe, so each thread gets its own session
+    mounted on one shared HTTPAdapter, whose urllib3 pool holds the connections.
+    With http2, a shared httpx client is used instead (needs the optional `h2` package);
+    async_client() gives one httpx.AsyncClient per event loop, aclose() closes it on its loop
+    before the loop itself is closed; close() only reaches the clients of the loops still running.
+
+    :param pool_size: max connections kept alive per host
+    :param retries: retries on connection errors and 429 / 5xx responses
+    :param backoff: backoff factor between retries, seconds
+    :param http2: use HTTP/2 through httpx when available
+    :param proxies: requests-style {'http': url, 'https': url}, used by the httpx clients as well
+    '''
+
+    def __init__(self, pool_size=8, retries=2, backoff=0.3, timeout=5, http2=False, proxies=None):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.timeout = timeout
+        self.proxies = proxies if isinstance(proxies, dict) else {}
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # the rpc is a POST, retry it as well
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        self.http2 = http2 and self.http2_available()
+        if http2 and not self.http2:
+            log.warning("http2 requested but httpx / h2 is not installed, using http/1.1")
+        self.client = None
+        self.async_clients = {}
+
+    @staticmethod
+    def http2_available():
+        if httpx is None:
+            return False
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            return False
+
+    def session(self) -> requests.Session:
+        s = getattr(self.local, "session", None)
+        if s is None:
+            s = requests.Session()
+            s.mount("https://", self.adapter)
+            s.mount("http://", self.adapter)
+            self.local.session = s
+        return s
+
+    def limits(self):
+        return httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+
+    def mounts(self, transport, http2):
+        """ one httpx transport per scheme, through the scheme's proxy as requests does """
+        mounts = {}
+        for scheme in ("http", "https"):
+            proxy = self.proxies.get(scheme, None)
+            mounts[f"{scheme}://"] = transport(
+                http2=http2, verify=False, retries=self.retries, limits=self.limits(),
+                proxy=httpx.Proxy(proxy) if proxy else None,
+            )
+        return mounts
+
+    def http2_client(self):
+        if not self.http2:
+            return None
+        with self.lock:
+            if self.client is None:
+                self.client = httpx.Client(
+                    timeout=self.timeout,
+                    mounts=self.mounts(httpx.HTTPTransport, True),
+                )
+            return self.client
+
+    def async_client(self):
+        if httpx is None:
+            return None
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.async_clients.get(loop, None)
+            if client is None:
+                client = self.async_clients[loop] = httpx.AsyncClient(
+                    timeout=self.timeout,
+                    mounts=self.mounts(httpx.AsyncHTTPTransport, self.http2),
+                )
+            return client
+
+    async def aclose(self):
+        """ close the running loop's client, from that loop """
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.async_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+            self.adapter.close()
+            clients = list(self.async_clients.items())
+            self.async_clients.clear()
+        for loop, client in clients:
+            # an async client closes on its own loop, the ones of a stopped loop are just dropped
+            if loop.is_closed() or not loop.is_running():
+                continue
+            try:
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(self.timeout)
+            except Exception as e:
+                log.debug(str(e))
+
+
 class GoogleTranslator:
     '''
     You can use 108 language in target and source,details view LANGUAGES.
@@ -91,10 +228,22 @@ class GoogleTranslator:
     :param proxies: proxies Will be used for every request.
     :type proxies: class : dict; like: {'http': 'http:171.112.169.47:19934/', 'https': 'https:171.112.169.47:19934/'}
 
+    :param pool: keep-alive connection pool, shared between translators.
+    :type pool: :class:`GoogleSessionPool`
+
     '''
 
-    def __init__(self, url_suffix="com", timeout=5, proxies=None):
+    def __init__(self, url_suffix="com", timeout=5, proxies=None, pool=None):
         self.proxies = proxies
+        if self.proxies == None or type(self.proxies) != dict:
+            self.proxies = {}
+        self.pool = pool
+        if self.pool is None:
+            self.pool = GoogleSessionPool(timeout=timeout, proxies=self.proxies)
+        elif len(self.proxies) <= 0:
+            self.proxies = self.pool.proxies
+        elif self.proxies != self.pool.proxies:
+            log.warning("proxies differ from the shared pool's, its httpx clients keep the pool's")
         if url_suffix not in URLS_SUFFIX:
             self.url_suffix = URL_SUFFIX_DEFAULT
         else:
@@ -114,7 +263,18 @@ class GoogleTranslator:
         freq = freq_initial
         return freq
 
-    def translate(self, text, lang_des='auto', lang_src='auto', pronounce=False):
+    def _headers(self):
+        return {
+            "Referer": "http://translate.google.{}/".format(self.url_suffix),
+            "User-Agent":
+                "Mozilla/5.0 (Windows NT 10.0; WOW64) "
+                "AppleWebKit/537.36 (KHTML, like Gecko) "
+                "Chrome/47.0.2526.106 Safari/537.36",
+            "Content-Type": "application/x-www-form-urlencoded;charset=utf-8"
+        }
+
+    def _translate_args(self, text, lang_des='auto', lang_src='auto'):
+        """ -> (rpc payload, None), or (None, result to return right away) """
         try:
             lang = LANGUAGES[lang_src]
         except:
@@ -125,73 +285,86 @@ class GoogleTranslator:
             lang_src = 'auto'
         text = str(text)
         if len(text) >= 5000:
-            return "Warning: Can only detect less than 5000 characters"
+            return None, "Warning: Can only detect less than 5000 characters"
         if len(text) == 0:
-            return ""
-        headers = {
-            "Referer": "http://translate.google.{}/".format(self.url_suffix),
-            "User-Agent":
-                "Mozilla/5.0 (Windows NT 10.0; WOW64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/47.0.2526.106 Safari/537.36",
-            "Content-Type": "application/x-www-form-urlencoded;charset=utf-8"
-        }
-        freq = self._package_rpc(text, lang_src, lang_des)
-        response = requests.Request(method='POST',
-                                    url=self.url,
-                                    data=freq,
-                                    headers=headers,
-                                    )
-        try:
-            if self.proxies == None or type(self.proxies) != dict:
-                self.proxies = {}
-            with requests.Session() as s:
-                s.proxies = self.proxies
-                r = s.send(request=response.prepare(),
-                           verify=False,
-                           timeout=self.timeout)
-            for line in r.iter_lines(chunk_size=1024):
-                decoded_line = line.decode('utf-8')
-                if "MkEWBc" in decoded_line:
-                    try:
-                        response = decoded_line
-                        response = json.loads(response)
-                        response = list(response)
-                        response = json.loads(response[0][2])
-                        response_ = list(response)
-                        response = response_[1][0]
-                        if len(response) == 1:
-                            if len(response[0]) > 5:
-                                sentences = response[0][5]
-                            else:  ## only url
-                                sentences = response[0][0]
-                                if pronounce == False:
-                                    return sentences
-                                elif pronounce == True:
-                                    return [sentences, None, None]
-                            translate_text = ""
-                            for sentence in sentences:
-                                sentence = sentence[0]
-                                translate_text += sentence.strip() + ' '
-                            translate_text = translate_text
-                            if pronounce == False:
-                                return translate_text
-                            elif pronounce == True:
-                                pronounce_src = (response_[0][0])
-                                pronounce_tgt = (response_[1][0][0][1])
-                                return [translate_text, pronounce_src, pronounce_tgt]
-                        elif len(response) == 2:
-                            sentences = []
-                            for i in response:
-                                sentences.append(i[0])
+            return None, ""
+        return self._package_rpc(text, lang_src, lang_des), None
+
+    def _parse_translate(self, lines, pronounce=False):
+        """ decoded response lines -> translation, None if the response has none """
+        for decoded_line in lines:
+            if "MkEWBc" in decoded_line:
+                try:
+                    response = decoded_line
+                    response = json.loads(response)
+                    response = list(response)
+                    response = json.loads(response[0][2])
+                    response_ = list(response)
+                    response = response_[1][0]
+                    if len(response) == 1:
+                        if len(response[0]) > 5:
+                            sentences = response[0][5]
+                        else:  ## only url
+                            sentences = response[0][0]
                             if pronounce == False:
                                 return sentences
                             elif pronounce == True:
-                                pronounce_src = (response_[0][0])
-                                pronounce_tgt = (response_[1][0][0][1])
-                                return [sentences, pronounce_src, pronounce_tgt]
-                    except Exception as e:
-                        raise e
+                                return [sentences, None, None]
+                        translate_text = ""
+                        for sentence in sentences:
+                            sentence = sentence[0]
+                            translate_text += sentence.strip() + ' '
+                        translate_text = translate_text
+                        if pronounce == False:
+                            return translate_text
+                        elif pronounce == True:
+                            pronounce_src = (response_[0][0])
+                            pronounce_tgt = (response_[1][0][0][1])
+                            return [translate_text, pronounce_src, pronounce_tgt]
+                    elif len(response) == 2:
+                        sentences = []
+                        for i in response:
+                            sentences.append(i[0])
+                        if pronounce == False:
+                            return sentences
+                        elif pronounce == True:
+                            pronounce_src = (response_[0][0])
+                            pronounce_tgt = (response_[1][0][0][1])
+                            return [sentences, pronounce_src, pronounce_tgt]
+                except Exception as e:
+                    raise e
+        return None
+
+    def _translate_http2(self, client, freq, pronounce=False):
+        try:
+            r = client.post(self.url, content=freq, headers=self._headers())
+            ret = self._parse_translate(r.iter_lines(), pronounce)
+            if ret is not None:
+                return ret
+            r.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            raise GoogleNewTranslationError(msg=str(e))
+        except httpx.HTTPError as e:
+            raise GoogleNewTranslationError(tts=self)
+
+    def translate(self, text, lang_des='auto', lang_src='auto', pronounce=False):
+        freq, early = self._translate_args(text, lang_des, lang_src)
+        if freq is None:
+            return early
+        client = self.pool.http2_client()
+        if client is not None:
+            return self._translate_http2(client, freq, pronounce)
+        try:
+            r = self.pool.session().post(self.url,
+                                         data=freq,
+                                         headers=self._headers(),
+                                         proxies=self.proxies,
+                                         verify=False,
+                                         timeout=self.timeout)
+            lines = (line.decode('utf-8') for line in r.iter_lines(chunk_size=1024))
+            ret = self._parse_translate(lines, pronounce)
+            if ret is not None:
+                return ret
             r.raise_for_status()
         except requests.exceptions.ConnectTimeout as e:
             raise e
@@ -202,33 +375,42 @@ class GoogleTranslator:
             # Request failed
             raise GoogleNewTranslationError(tts=self)
 
+    async def translate_async(self, text, lang_des='auto', lang_src='auto', pronounce=False):
+        """ translate() on the running event loop, through the loop's pooled httpx client """
+        client = self.pool.async_client()
+        if client is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, functools.partial(self.translate, text, lang_des, lang_src, pronounce))
+        freq, early = self._translate_args(text, lang_des, lang_src)
+        if freq is None:
+            return early
+        try:
+            r = await client.post(self.url, content=freq, headers=self._headers())
+            ret = self._parse_translate(r.text.splitlines(), pronounce)
+            if ret is not None:
+                return ret
+            r.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            raise GoogleNewTranslationError(msg=str(e))
+        except httpx.HTTPError as e:
+            raise GoogleNewTranslationError(tts=self)
+
     def detect(self, text):
         text = str(text)
         if len(text) >= 5000:
             return log.debug("Warning: Can only detect less than 5000 characters")
         if len(text) == 0:
             return ""
-        headers = {
-            "Referer": "http://translate.google.{}/".format(self.url_suffix),
-            "User-Agent":
-                "Mozilla/5.0 (Windows NT 10.0; WOW64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/47.0.2526.106 Safari/537.36",
-            "Content-Type": "application/x-www-form-urlencoded;charset=utf-8"
-        }
+        headers = self._headers()
         freq = self._package_rpc(text)
-        response = requests.Request(method='POST',
-                                    url=self.url,
-                                    data=freq,
-                                    headers=headers)
         try:
-            if self.proxies == None or type(self.proxies) != dict:
-                self.proxies = {}
-            with requests.Session() as s:
-                s.proxies = self.proxies
-                r = s.send(request=response.prepare(),
-                           verify=False,
-                           timeout=self.timeout)
+            r = self.pool.session().post(self.url,
+                                         data=freq,
+                                         headers=headers,
+                                         proxies=self.proxies,
+                                         verify=False,
+                                         timeout=self.timeout)
 
             for line in r.iter_lines(chunk_size=1024):
                 decoded_line = line.decode('utf-8')
@@ -12,6 +12,7 @@ class RBarrage:
             cfg: dict = None,
             timing: int = 0,
             priority: int = 0,
+            key: str = None,
     ):
         self.root = root
         self.text = text
@@ -19,6 +20,7 @@ class RBarrage:
 
         self.timing = timing
         self.priority = priority
+        self.key = key
 
         self.me = None
         self.label = None
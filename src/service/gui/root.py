@@ -170,6 +170,7 @@ class RGuiRoot:
             font_background: str = '',
             timing: int = 0,
             priority: int = 0,
+            key: str = None,
     ):
 
         if text is None or len(text) <= 0:
@@ -184,6 +185,7 @@ class RGuiRoot:
             cfg=cfg_barrage,
             timing=timing,
             priority=priority,
+            key=key,
         )
 
         if font is not None:
@@ -211,6 +213,14 @@ class RGuiRoot:
         try:
             self.lock.acquire()
 
+            # same key: replace the shown barrage in place
+            if nova.key is not None:
+                for unit in self.barrages:
+                    if unit.key == nova.key:
+                        self.barrages.remove(unit)
+                        unit.destroy()
+                        break
+
             barrage_count = len(self.barrages)
 
             legacy = None
@@ -1,6 +1,3 @@
-from tkinter.font import Font
-
-
 class RTextAttr:
     family = "Consolas"
     size = 16
@@ -43,6 +40,8 @@ class RTextAttr:
         return self
 
     def apply(self, target):
+        from tkinter.font import Font
+
         f = Font(family=self.family, size=self.size)
         target.config(
             font=f,
@@ -0,0 +1,124 @@
+"""
+MetricsCtrl exposes the metrics of the task control: prometheus text on http://host:port/metrics,
+and a json snapshot to the log every `snapshot` seconds.
+"""
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src import rtask
+from src.common import sim
+from src.common.breaker import CircuitBreaker
+from src.common.cache import LruCache
+
+
+class MetricsCtrl:
+
+    QUEUES = ("command", "denoise", "slice", "transcribe", "translate", "manifest")
+
+    def __init__(self, task_ctrl: rtask.RTaskControl):
+        self.task_ctrl = task_ctrl
+        self.registry = task_ctrl.metrics
+        self.active = False
+        self.host = "127.0.0.1"
+        self.port = 9464
+        self.snapshot = 0
+
+        self.server: ThreadingHTTPServer = None
+        self.stop_event = threading.Event()
+
+        self.logger = logging.getLogger('metrics')
+
+    def configure(self) -> 'MetricsCtrl':
+        cfg = sim.getv(self.task_ctrl.cfg, {}, "metrics")
+        self.active = sim.getv(cfg, False, "active")
+        self.host = sim.getv(cfg, "127.0.0.1", "host")
+        self.port = sim.getv(cfg, 9464, "port")
+        self.snapshot = sim.getv(cfg, 60, "snapshot")
+        self.registry.collector("queues", self.collect_queues)
+        self.registry.collector("shares", self.collect_shares)
+        self.registry.collector("arena", self.collect_arena)
+        return self
+
+    def collect_queues(self, registry):
+        depth = registry.gauge("queue_depth", "Tasks waiting in the queue", ("queue",))
+        for name in self.QUEUES:
+            depth.set(getattr(self.task_ctrl, f"queue_{name}").qsize(), queue=name)
+
+    def collect_arena(self, registry):
+        arena = self.task_ctrl.arena
+        if arena is None:
+            return
+        gauge = registry.gauge("arena_stat", "Audio arena samples and blocks", ("stat",))
+        for stat, value in arena.stats().items():
+            gauge.set(value, stat=stat)
+
+    def collect_shares(self, registry):
+        """ caches and circuit breakers are shared objects of the task control """
+        with self.task_ctrl.shares_lock:
+            shares = list(self.task_ctrl.shares.items())
+        for key, share in shares:
+            if isinstance(share, LruCache):
+                stats = share.stats()
+                gauge = registry.gauge("cache_stat", "In-process cache counters and hit rate", ("cache", "stat"))
+                for stat, value in stats.items():
+                    gauge.set(value, cache=key, stat=stat)
+            elif isinstance(share, CircuitBreaker):
+                snapshot = share.snapshot()
+                state = registry.gauge("breaker_state", "Circuit state, 0: closed, 1: half open, 2: open", ("agent",))
+                state.set(snapshot["state_value"], agent=share.name)
+                gauge = registry.gauge("breaker_stat", "Circuit breaker counters", ("agent", "stat"))
+                for stat, value in snapshot.items():
+                    if stat != "state_value" and isinstance(value, (int, float)):
+                        gauge.set(value, agent=share.name, stat=stat)
+
+    def serve(self):
+        registry = self.registry
+        logger = self.logger
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                try:
+                    body = registry.render().encode("utf-8")
+                except Exception as ex:
+                    logger.error(ex, exc_info=True, stack_info=True)
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logger.debug(fmt % args)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.logger.info(f"serving on http://{self.host}:{self.port}/metrics")
+        self.server.serve_forever()
+
+    def log_snapshot(self):
+        while not self.stop_event.wait(self.snapshot):
+            try:
+                self.logger.info(json.dumps(self.registry.snapshot(), ensure_ascii=False))
+            except Exception as ex:
+                self.logger.error(ex, exc_info=True, stack_info=True)
+
+    def start(self):
+        if not self.active:
+            return
+        threading.Thread(target=self.serve, name="metrics-http", daemon=True).start()
+        if self.snapshot > 0:
+            threading.Thread(target=self.log_snapshot, name="metrics-snapshot", daemon=True).start()
+
+    def close(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
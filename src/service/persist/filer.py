@@ -57,7 +57,7 @@ class RPersistToFile(threading.Thread):
             sim.Collection.insort_ex(
                 self.buffer,
                 task,
-                key=lambda item: item.info.times["create"]
+                key=lambda item: item.info.time_get("capture")
             )
             self.buffer.append(task)
         finally:
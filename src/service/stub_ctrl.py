@@ -0,0 +1,38 @@
+"""
+StubCtrl is a stand-in translation agent for benchmarks: it answers after a simulated latency,
+without any backend, so that runs measure the pipeline and not the network.
+"""
+import asyncio
+import logging
+import random
+
+from src.common import sim
+
+
+class StubCtrl:
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.active = False
+        # ms
+        self.delay = 0
+        self.jitter = 0
+        self.error_rate = 0.0
+        self.rng = random.Random(0)
+        self.logger = logging.getLogger('stub-trans')
+
+    def configure(self) -> 'StubCtrl':
+        stub_cfg = sim.getv(self.cfg, {}, "translator", "agent_stub")
+        self.active = sim.getv(stub_cfg, False, "active")
+        self.delay = sim.getv(stub_cfg, 100, "delay")
+        self.jitter = sim.getv(stub_cfg, 0, "jitter")
+        self.error_rate = sim.getv(stub_cfg, 0.0, "error_rate")
+        self.rng = random.Random(sim.getv(stub_cfg, 0, "seed"))
+        return self
+
+    async def translate(self, text, lang_src, lang_des):
+        delay = max(0.0, self.delay + self.rng.uniform(-self.jitter, self.jitter))
+        await asyncio.sleep(delay / 1000)
+        if self.rng.random() < self.error_rate:
+            raise Exception("stub failure")
+        return f"[{lang_src}->{lang_des}] {text}"